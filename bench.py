@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark hms modes against a scratch database of a chosen size.
+# scp and ssh are replaced with local fakes so publish runs offline.
+#
+
+import getopt, sys, configparser, os, subprocess
+import json, random, statistics, tempfile, shutil, time, platform
+from contextlib import redirect_stdout
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import hms
+
+HMS = os.path.join(HERE, 'hms.py')
+
+FAKE_SCP = """#!{python}
+import sys, os, shutil
+src, dst = sys.argv[-2], sys.argv[-1]
+host, path = dst.split(':', 1)
+out = os.path.join({root!r}, host.split('@')[-1], path.lstrip('/'))
+os.makedirs(os.path.dirname(out), exist_ok=True)
+shutil.copy(src, out)
+"""
+
+FAKE_SSH = """#!/bin/sh
+exit 0
+"""
+
+
+def usage(msg=None):
+    if msg is not None:
+        print('\nERROR: ' + msg + '\n')
+    print('''
+Usage:  bench.py -c bench.ini [ -H hosts ] [ -N cnames ] [ -S subnets ] [ -r repeats ]
+                 [ -o results.json ] [ --compare old.json ] [ --no-seed ]
+                 [ --startup-limit ms ]
+
+ -c => hms.ini style file whose DEFAULT section points at a scratch database,
+       MySQL or SQLite. Its name (DB or Path) must contain "bench"; the hms
+       tables there are recreated.
+ -H => Hosts to assign. (default 2000)
+ -N => CNAMEs to create. (default 200)
+ -S => /24 subnets in the pool. (default 16)
+ -r => Repeats per measurement. (default 5)
+ -o => Write results as JSON.
+ --compare => Print the change against an earlier results file.
+ --no-seed => Reuse the tables from the last run.
+ --startup-limit => Fail if -V or a usage error takes longer than this (median),
+       or if -V loads a database driver or subprocess.
+''')
+    sys.exit(1)
+
+
+def connect(settings):
+    return hms.connect_db(settings)
+
+
+def seed(cnx, nhosts, ncnames, nsubnets):
+    # Subnets are consecutive /24s from 10.0.0.0, minus network and broadcast.
+    pool = [(10 << 24) + (s << 8) + i for s in range(nsubnets) for i in range(1, 255)]
+    if nhosts > len(pool):
+        usage(f'{nhosts} hosts do not fit in {nsubnets} subnets.')
+    rnd = random.Random(42)
+    cur = cnx.cursor()
+    for table in ('hms_ip', 'hms_cname', 'hms_subnet', 'hms_change', 'hms_publish'):
+        cur.execute(f'drop table if exists {table}')
+    for stmt in cnx.SCHEMA:
+        cur.execute(stmt)
+    cur.executemany('insert into hms_subnet (first, last, bits) values (%s, %s, 24)',
+                    [((10 << 24) + (s << 8), (10 << 24) + (s << 8) + 255) for s in range(nsubnets)])
+    used = set(rnd.sample(range(len(pool)), nhosts))
+    rows = []
+    for n, ip in enumerate(pool):
+        if n in used:
+            rows.append((f'bench{n}', '%012x' % (0x020000000000 + n), ip, 'bench host', rnd.choice('YN')))
+        else:
+            rows.append((None, None, ip, None, 'N'))
+    for i in range(0, len(rows), 1000):
+        cur.executemany('insert into hms_ip (host, mac, ip, descr, dhcp) values (%s, %s, %s, %s, %s)',
+                        rows[i:i + 1000])
+    hosts = [r[0] for r in rows if r[0] is not None]
+    cur.executemany('insert into hms_cname (cname, host) values (%s, %s)',
+                    [(f'alias{n}', f'{rnd.choice(hosts)}.bench.example') for n in range(ncnames)])
+    cnx.commit()
+    return len(pool)
+
+
+def bench_config(config, tmpdir, nsubnets):
+    # The scratch DB plus a BIND section pointing at the fake servers.
+    out = configparser.ConfigParser()
+    out.read_dict({'DEFAULT': dict(config.defaults())})
+    nets = sorted({s >> 8 for s in range(nsubnets)})
+    out['BIND'] = {
+        'Domain': 'bench.example',
+        'Host': 'bench1,bench2',
+        'NSList': 'ns1.bench.example,ns2.bench.example',
+        'Key': '/dev/null',
+        'FwdZoneDestName': 'bench.example,/etc/bind/bench.example',
+        'RevZoneDestName': ':'.join(f'{n}.10.in-addr.arpa,/etc/bind/{n}.10.in-addr.arpa' for n in nets),
+        'User': 'root',
+        'Port': '22',
+        'StateFile': os.path.join(tmpdir, 'publish.json'),
+    }
+    path = os.path.join(tmpdir, 'hms.ini')
+    with open(path, 'w') as file:
+        out.write(file)
+    return path
+
+
+def fake_tools(tmpdir):
+    bindir = os.path.join(tmpdir, 'bin')
+    os.makedirs(bindir)
+    for name, text in (('scp', FAKE_SCP.format(python=sys.executable, root=os.path.join(tmpdir, 'servers'))),
+                       ('ssh', FAKE_SSH)):
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as file:
+            file.write(text)
+        os.chmod(path, 0o755)
+    return bindir
+
+
+def timed(fn, repeats, setup=None, teardown=None):
+    times = []
+    for i in range(repeats):
+        if setup is not None:
+            setup(i)
+        start = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - start)
+        if teardown is not None:
+            teardown(i)
+    return {'min': min(times), 'median': statistics.median(times), 'max': max(times), 'runs': repeats}
+
+
+def quiet(fn, *args):
+    # hms functions print and sometimes exit; neither matters here.
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        try:
+            fn(*args)
+        except SystemExit:
+            pass
+
+
+def run_hms(env, *args, expect=0):
+    # Output goes to a scratch file and is only read back when the exit
+    # status is not the expected one, which stops the benchmark: a refused
+    # add or a publish stopped by the zone check must not time as a success.
+    with tempfile.TemporaryFile() as out:
+        result = subprocess.run([sys.executable, HMS] + list(args), env=env, stdout=out, stderr=subprocess.STDOUT)
+        if result.returncode != expect:
+            out.seek(0)
+            tail = out.read().decode(errors='replace')[-2000:]
+            print(f"hms {' '.join(args)} exited {result.returncode}, expected {expect}:\n{tail}")
+            sys.exit(1)
+
+
+def end_to_end(env, repeats):
+    results = {}
+    results['version'] = timed(lambda i: run_hms(env, '-V'), repeats)
+    results['usage_error'] = timed(lambda i: run_hms(env, '-L', '-i', 'bogus', expect=1), repeats)
+    results['add'] = timed(lambda i: run_hms(env, '-A', '-h', f'benchadd{i}', '-d', 'bench'), repeats,
+                           teardown=lambda i: run_hms(env, '-D', '-h', f'benchadd{i}'))
+    results['list'] = timed(lambda i: run_hms(env, '-L'), repeats)
+    results['freelist'] = timed(lambda i: run_hms(env, '-F'), repeats)
+    results['publish'] = timed(lambda i: run_hms(env, '-P', '--force'), repeats)
+    return results
+
+
+def phases(settings, repeats):
+    results = {}
+    results['connect'] = timed(lambda i: connect(settings).close(), repeats)
+    cnx = connect(settings)
+    results['add'] = timed(lambda i: quiet(hms.do_add, cnx, None, f'benchadd{i}', 'bench', None, 'N'), repeats,
+                           teardown=lambda i: quiet(hms.do_delete, cnx, None, f'benchadd{i}'))
+    results['list'] = timed(lambda i: quiet(hms.do_list, cnx, None, None), repeats)
+    results['freelist'] = timed(lambda i: quiet(hms.do_freelist, cnx), repeats)
+
+    # 100 adds in one batch through the library, for comparison with -A.
+    api = hms.HMS(cnx=cnx)
+    results['api_add_100'] = timed(lambda i: api.add_many([(f'benchapi{i}x{n}',) for n in range(100)]), repeats,
+                                   teardown=lambda i: api.delete_many([(None, f'benchapi{i}x{n}') for n in range(100)]))
+
+    # A whole /16 of free addresses, outside the seeded 10.0.0.0 subnets.
+    results['add_subnet_16'] = timed(lambda i: api.add_subnet('172.16.0.0/16'), repeats,
+                                     teardown=lambda i: api.retire_subnet('172.16.0.0/16'))
+
+    # publish, split into reading/rendering and pushing.
+    render = []
+    push = []
+    for i in range(repeats):
+        tmpdir = tempfile.mkdtemp(prefix='hms-bench-')
+        try:
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                out = hms.BindPublish(settings.config, tmpdir, True)
+                hms.read_snapshot(cnx, [out])
+                mid = time.perf_counter()
+                out.push()
+            render.append(mid - start)
+            push.append(time.perf_counter() - mid)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    for name, times in (('publish_render', render), ('publish_push', push)):
+        results[name] = {'min': min(times), 'median': statistics.median(times), 'max': max(times), 'runs': repeats}
+    cnx.close()
+    return results
+
+
+def startup_imports(env):
+    # Modules that -V must never load.
+    result = subprocess.run([sys.executable, '-X', 'importtime', HMS, '-V'], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    loaded = {line.split('|')[-1].strip() for line in result.stderr.splitlines() if '|' in line}
+    return sorted(m for m in loaded if m.split('.')[0] in ('mysql', 'sqlite3', 'subprocess', 'concurrent'))
+
+
+def compare(old, new):
+    print(f"\n{'measurement':<32}{'old':>12}{'new':>12}{'change':>10}")
+    for kind in ('end_to_end', 'phases'):
+        for name, res in new[kind].items():
+            before = old.get(kind, {}).get(name)
+            if before is None:
+                continue
+            a = before['median']
+            b = res['median']
+            print(f"{kind + '.' + name:<32}{a:>12.4f}{b:>12.4f}{(b - a) / a * 100 if a else 0:>+9.1f}%")
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'c:H:N:S:r:o:', ['compare=', 'no-seed', 'startup-limit='])
+    except getopt.GetoptError as err:
+        usage("{}".format(err))
+
+    cfgfile = None
+    nhosts = 2000
+    ncnames = 200
+    nsubnets = 16
+    repeats = 5
+    outfile = None
+    oldfile = None
+    doseed = True
+    limit = None
+    try:
+        for o, a in opts:
+            if o == '-c':
+                cfgfile = a
+            elif o == '-H':
+                nhosts = int(a)
+            elif o == '-N':
+                ncnames = int(a)
+            elif o == '-S':
+                nsubnets = int(a)
+            elif o == '-r':
+                repeats = max(1, int(a))
+            elif o == '-o':
+                outfile = a
+            elif o == '--compare':
+                oldfile = a
+            elif o == '--no-seed':
+                doseed = False
+            elif o == '--startup-limit':
+                limit = float(a)
+    except ValueError as err:
+        usage("{}".format(err))
+
+    if cfgfile is None or not os.path.exists(cfgfile):
+        usage('A config file for the scratch database is required.')
+    config = configparser.ConfigParser()
+    config.read(cfgfile)
+    if config.get('DEFAULT', 'Backend', fallback='mysql').lower() == 'sqlite':
+        dbname = config.get('DEFAULT', 'Path', fallback='')
+    else:
+        dbname = config.get('DEFAULT', 'DB', fallback='')
+    if 'bench' not in os.path.basename(dbname):
+        usage('Refusing to use a database whose name does not contain "bench".')
+
+    tmpdir = tempfile.mkdtemp(prefix='hms-bench-')
+    try:
+        cfgpath = bench_config(config, tmpdir, nsubnets)
+        settings = hms.Settings(cfgpath)
+        bindir = fake_tools(tmpdir)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        env = dict(os.environ, HMS_CONFIG=cfgpath)
+
+        pool = None
+        if doseed:
+            print(f'Seeding {nhosts} hosts, {ncnames} CNAMEs in {nsubnets} /24s...')
+            cnx = connect(settings)
+            start = time.perf_counter()
+            pool = seed(cnx, nhosts, ncnames, nsubnets)
+            print(f'Seeded {pool} addresses in {time.perf_counter() - start:.2f}s')
+            cnx.close()
+
+        print('Timing end to end...')
+        e2e = end_to_end(env, repeats)
+        print('Timing phases...')
+        ph = phases(settings, repeats)
+        imports = startup_imports(env)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    results = {
+        'hms_version': hms.VERSION,
+        'when': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'params': {'hosts': nhosts, 'cnames': ncnames, 'subnets': nsubnets, 'repeats': repeats, 'pool': pool},
+        'end_to_end': e2e,
+        'phases': ph,
+        'startup_imports': imports,
+    }
+    for kind in ('end_to_end', 'phases'):
+        for name, res in results[kind].items():
+            print(f"{kind + '.' + name:<32} median {res['median']:.4f}s  min {res['min']:.4f}s")
+    if outfile is not None:
+        with open(outfile, 'w') as file:
+            json.dump(results, file, indent=1)
+        print(f'Results written to {outfile}')
+    if oldfile is not None:
+        with open(oldfile, 'r') as file:
+            compare(json.load(file), results)
+
+    if limit is not None:
+        slow = [name for name in ('version', 'usage_error') if e2e[name]['median'] * 1000 > limit]
+        for name in slow:
+            print(f"Startup regression: {name} took {e2e[name]['median'] * 1000:.1f}ms, limit is {limit}ms.")
+        if imports:
+            print('Startup regression: -V loaded {}.'.format(', '.join(imports)))
+        if slow or imports:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
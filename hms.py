@@ -1,22 +1,195 @@
 #!/usr/bin/env python3
 
-import getopt, sys, configparser, os, subprocess
-import re, mysql.connector
+import getopt, sys, configparser, os
+import re, json, ipaddress, socket, time
 from datetime import datetime
+from collections import namedtuple
+# Anything else is imported where it is used, so -V, usage errors and
+# daemon clients do not pay for it.
 
 VERSION = "1.2.1-20260106"
-CONFIG = "/etc/hms.ini"
+CONFIG = os.environ.get('HMS_CONFIG', "/etc/hms.ini")
 FIXED = "/etc/hms.fixed"
+DBPATH = "/var/lib/hms/hms.db"
+SOCKET = "/run/hms.sock"
+POOL = 4
+DAEMON_MODES = list("ACDFLMPR")
+FORMATS = ['text', 'table', 'json', 'csv', 'tsv']
+WORKERS = 8
+POLL = 2
+DEBOUNCE = 10
+MININTERVAL = 60
+LOCKTIMEOUT = 3600
+STATE = "/var/lib/hms/publish.json"
+RECORDS = "/var/lib/hms/records.json"
+BATCH = 500
+TTL = 300
+CACHETTL = 300
+STALEDAYS = 90
+INSERTBATCH = 500
+MINPREFIX = 16
+DHCPCHECK = "dhcpd -t -cf /etc/dhcp/dhcpd.conf"
+SUBNET_TABLE = """create table if not exists hms_subnet(
+    first int unsigned primary key
+    , last int unsigned not null
+    , bits tinyint unsigned not null
+    , descr varchar(256)
+)"""
+# One row, bumped by every change to hms_ip or hms_cname.
+CHANGE_TABLE = """create table if not exists hms_change(
+    id int primary key
+    , counter bigint not null
+)"""
+# One row, held by whoever is publishing.
+PUBLISH_TABLE = """create table if not exists hms_publish(
+    id int primary key
+    , owner varchar(64)
+    , started bigint
+    , pending int not null
+    , forced int not null default 0
+)"""
+SERIALLINE = re.compile(r'^\s*\d+\s*; serial.*$', re.M)
+
+IPVALID = re.compile('^(?:(?:25[0-5]|(?:2[0-4]|1\\d|[1-9]|)\\d)\\.?\\b){4}$')
+MACVALID = re.compile('^(?:[0-9a-fA-F]){12}$')
+FQDNVALID = re.compile('^[a-zA-Z][a-zA-Z0-9\\.\\-]{1,254}$')
+HOSTVALID = re.compile('^[a-zA-Z][a-zA-Z0-9\\-]{1,31}$')
+HOSTGLOB = re.compile('^[a-zA-Z0-9\\-\\*\\?]{1,32}$')
+DESCVALID = re.compile('^[\\ a-zA-Z0-9_\\-\\.]{1,255}$')
+UNIQUEFAIL = re.compile(r"for key '(?:\w+\.)?(\w+)'|UNIQUE constraint failed: \w+\.(\w+)")
+INUSE = {
+    'host': 'Host %s is already in use.',
+    'mac': 'MAC %s is already in use.',
+    'ip': 'IP %s is already in use.',
+    'cname': 'CNAME %s is already in use.',
+}
+
+def ip2int(ip):
+    return int(ipaddress.IPv4Address(ip))
+
+
+def int2ip(n):
+    return str(ipaddress.IPv4Address(n))
+
 
 def get_serial():
     return datetime.now().strftime("%y%m%d%H%M")
 
 
+def load_state(path):
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(state, file, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as err:
+        print(f'Warning: could not save publish state to {path}: {err}')
+
+
 def bail():
     print('Something went wrong. See above for some kind of hint.')
     sys.exit(255)
 
 
+class Metrics:
+    # Where the time went in this run, and how much was done. Phases are
+    # keyed by name and host, so push threads never share an entry.
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+
+    def add(self, seconds, name, host=None):
+        entry = self.phases.get((name, host))
+        if entry is None:
+            self.phases[(name, host)] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def timed(self, name, host=None):
+        return Phase(self, name, host)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        # stderr, so it does not end up in --format output.
+        out = sys.stderr
+        print('\nTiming:', file=out)
+        for (name, host), (calls, seconds) in self.phases.items():
+            label = name if host is None else f'{name} {host}'
+            print(f'  {label:<40} {calls:>6} {seconds:>10.4f}s', file=out)
+        print(f"  {'total':<40} {'':>6} {time.perf_counter() - self.start:>10.4f}s", file=out)
+        if self.counters:
+            print('Counters:', file=out)
+            for name, value in self.counters.items():
+                print(f'  {name:<40} {value:>17}', file=out)
+
+    def write_textfile(self, directory, mode, status):
+        # For the node_exporter textfile collector, one file per mode so a
+        # listing does not overwrite the last publish.
+        def labels(**kw):
+            return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                            for k, v in kw.items() if v is not None)
+        lines = ['# HELP hms_phase_seconds Seconds spent in each phase of the last run.',
+                 '# TYPE hms_phase_seconds gauge']
+        for (name, host), (calls, seconds) in self.phases.items():
+            lines.append(f'hms_phase_seconds{{{labels(mode=mode, phase=name, host=host)}}} {seconds:.6f}')
+        lines += ['# HELP hms_phase_calls Times each phase ran in the last run.',
+                  '# TYPE hms_phase_calls gauge']
+        for (name, host), (calls, seconds) in self.phases.items():
+            lines.append(f'hms_phase_calls{{{labels(mode=mode, phase=name, host=host)}}} {calls}')
+        lines += ['# HELP hms_count Rows, bytes and hosts handled in the last run.',
+                  '# TYPE hms_count gauge']
+        for name, value in self.counters.items():
+            lines.append(f'hms_count{{{labels(mode=mode, name=name)}}} {value}')
+        lines += ['# HELP hms_run_seconds Duration of the last run.',
+                  '# TYPE hms_run_seconds gauge',
+                  f'hms_run_seconds{{{labels(mode=mode)}}} {time.perf_counter() - self.start:.6f}',
+                  '# HELP hms_run_status Exit status of the last run.',
+                  '# TYPE hms_run_status gauge',
+                  f'hms_run_status{{{labels(mode=mode)}}} {status}',
+                  '# HELP hms_run_timestamp_seconds When the last run finished.',
+                  '# TYPE hms_run_timestamp_seconds gauge',
+                  f'hms_run_timestamp_seconds{{{labels(mode=mode)}}} {int(time.time())}']
+        path = os.path.join(directory, f'hms_{mode}.prom')
+        try:
+            with open(path + '.tmp', 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+            os.replace(path + '.tmp', path)
+        except OSError as err:
+            print(f'Warning: could not write metrics to {path}: {err}')
+
+
+class Phase:
+    def __init__(self, metrics, name, host):
+        self.metrics = metrics
+        self.name = name
+        self.host = host
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add(time.perf_counter() - self.start, self.name, self.host)
+        return False
+
+
+# Replaced for every publish by -W.
+METRICS = Metrics()
+
+
 def config_default_usage():
     print(f"Check the {CONFIG} file for valid options.\nSee sample below.")
     print("""
@@ -26,6 +199,18 @@ DB = hms
 User = hms
 Pwd = pwd
 Port = 3306
+
+or, for a local SQLite database,
+
+[DEFAULT]
+Backend = sqlite
+Path = /var/lib/hms/hms.db
+
+# optional, a local copy for -L and -F, checked against the database on
+# every run and reloaded when anything changed or it is TTL seconds old.
+[CACHE]
+Path = /var/cache/hms/cache.db
+TTL = 300
 """)
     sys.exit(1)
 
@@ -43,6 +228,19 @@ FwdZoneDestName = cs.skidmore.edu,/etc/bind/cs.skidmore.edu
 RevZoneDestName = 36.222.141.in-addr.arpa,/etc/bind/staged-36.222.141.in-addr.arpa,141.222.36.%%:37.222.141.in-addr.arpa,/etc/bind/staged-37.222.141.in-addr.arpa,141.222.37.%%
 User = root
 Port = 22
+# optional, parallel pushes.
+Workers = 8
+# optional, where zone fingerprints are kept.
+StateFile = /var/lib/hms/publish.json
+# optional, zones are checked here before any push. Check is also run on
+# each server after the copy, as Check zone file; empty to skip it.
+Validate = yes
+Check = named-checkzone
+# optional, send changes as dynamic updates instead of copying zones.
+Update = nsupdate -k /etc/hms/hms.key
+UpdateServer = 141.222.36.200
+UpdateBatch = 500
+RecordFile = /var/lib/hms/records.json
 """)
     print("""
 [DHCP]
@@ -51,6 +249,28 @@ Key = /root/.ssh/id_dhcp
 DestName = /etc/dhcp/dhcptail.conf
 User = root
 Port = 22
+# optional, run on each server after the copy. Empty to skip.
+Check = dhcpd -t -cf /etc/dhcp/dhcpd.conf
+# optional, as for BIND.
+Workers = 8
+StateFile = /var/lib/hms/publish.json
+""")
+    print("""
+# optional, seconds before a publish lock is presumed stale.
+[PUBLISH]
+LockTimeout = 3600
+
+# optional, Prometheus textfile collector directory.
+[METRICS]
+TextfileDir = /var/lib/prometheus/node-exporter
+
+# optional, for -W. Times are in seconds.
+[WATCH]
+Poll = 2
+Debounce = 10
+MaxDelay = 60
+MinInterval = 60
+MetricsFile = /var/lib/hms/watch.json
 """)
     sys.exit(1)
 
@@ -59,19 +279,30 @@ def usage(msg=None):
     if msg is not None:
         print('\nERROR: ' + msg + '\n')
     print('''
-Usage:  hms -A -h hostname [ -i ip ] [ -d description ] [ -m mac ] [ -x ]
-        hms -C -c cname -h hostname
+Usage:  hms -A -h hostname [ -i ip | -s subnet ] [ -d description ] [ -m mac ] [ -x ]
+        hms -B [ -a ] [ file ]
+        hms -C -c cname -h { hostname | target.fqdn }
         hms -D { -h hostname | -i ip | -c cname }
-        hms -F
-        hms -L [ {-h hostname | -i ip} ]
+        hms -F [ -s subnet ] [ --format fmt ] [ --limit n ] [ --after ip ]
+        hms -F [ -s subnet ] { --ranges | --summary [ --threshold pct ] } [ --format fmt ]
+        hms -L [ {-h hostname | -i ip | -s subnet} ] [ --host glob ] [ --dhcp y|n ] [ --mac y|n ]
+               [ --desc text ] [ --format fmt ] [ --limit n ] [ --after ip ]
+               [ --no-cache | --invalidate ]
         hms -M -h hostname [ -d description ] [ -m mac ] [ {-x|-X} ]
-        hms -P
+        hms -P [ --force ]
         hms -R { -h hostname | -c cname } -n newname
         hms -V
+        hms -W
+        hms --add-subnet -s subnet [ -d description ] [ --exclude ranges ] [ --force ]
+        hms --retire-subnet -s subnet
+        hms --reconcile leases [ -s subnet ] [ --dhcp y|n ] [ --days n ] [ --format fmt ]
+        hms --migrate
+        hms --serve
 ''')
 
     print('''
  -A => Add entry.
+ -B => Bulk add/modify from CSV file or stdin.
  -C => Create CNAME entry.
  -D => Delete entry. (Does not ask for confirmation!)
  -F => Display free list.
@@ -80,97 +311,949 @@ Usage:  hms -A -h hostname [ -i ip ] [ -d description ] [ -m mac ] [ -x ]
  -P => Publish DNS/DHCP to servers based on config stanza.
  -R => Rename host entry. (Does not ask for confirmation!)
  -V => Print version.
+ -W => Watch for changes and publish them, batched.
  -x => Mark entry to use DHCP.
  -X => Disable DHCP.
+ -a => With -B, reject the whole batch if any row fails.
+ -s => Limit to a subnet (CIDR). With -A, take the next free IP from it.
+ --force => With -P, push every zone even if unchanged. With --add-subnet,
+       allow a subnet larger than a /16.
+ --format => With -L or -F, one of text (default), table, json, csv or tsv.
+ --host, --dhcp, --mac, --desc => With -L, only names matching a glob, entries
+       with DHCP on or off, with or without a MAC, or with text in the description.
+ --limit, --after => With -L or -F, at most n entries, starting after an address.
+ --ranges => With -F, free addresses as ranges and CIDR blocks.
+ --summary => With -F, used and free addresses per subnet.
+ --threshold => With --summary, exit 7 if any subnet is at least pct used.
+ --add-subnet => Add every address in a subnet to the free pool, except the
+       network and broadcast addresses and any --exclude ranges (a.b.c.d,
+       a.b.c.d-a.b.c.e or CIDR, comma separated).
+ --retire-subnet => Remove a subnet's free addresses. Refused while any are assigned.
+ --reconcile => Compare entries with a dhcpd leases file (- for stdin): entries
+       whose MAC has had no lease in --days (default 90), MACs hms does not know,
+       and active leases that disagree with an entry. Exit 7 if any are found.
+ --migrate => Convert an existing database to numeric addresses and subnets.
+ --serve => Run as a daemon on a unix socket; other hms runs use it when it is up.
+ --direct => Do not use the daemon even if it is running.
+ --timing => Print where the time went, and counters, when done.
+ --no-cache => With -L or -F, read the database even if a cache is configured.
+ --invalidate => With -L or -F, reload the cache before reading it.
 ''')
     sys.exit(1)
 
 
-def check_mac_inuse(cnx, mac):
-    try:
-        cur = cnx.cursor()
-        cur.execute("SELECT mac FROM hms_ip WHERE mac = %s ", (mac,))
-        cur.fetchone()
-        return True if cur.rowcount > 0 else False
-    except mysql.connector.Error as err:
-        print('MySQL error: {}'.format(err))
-        bail()
+class HMSError(Exception):
+    pass
+
+
+class DBError(HMSError):
+    pass
+
+
+class UsageError(HMSError):
+    pass
+
+
+class ConfigError(UsageError):
+    # A missing or bad BIND or DHCP setting.
+    pass
+
+
+class PublishError(HMSError):
+    # A zone failed its checks, or a copy, check or update failed.
+    pass
+
+
+class InUseError(HMSError):
+    pass
+
+
+class NotFoundError(HMSError):
+    pass
+
+
+class NoFreeIPError(HMSError):
+    pass
+
+
+class BatchError(HMSError):
+    # Which entry of a batch failed. Nothing from the batch was written.
+    def __init__(self, index, error):
+        super().__init__(f'Entry {index}: {error}')
+        self.index = index
+        self.error = error
+
+
+Host = namedtuple('Host', ['host', 'ip', 'mac', 'descr', 'dhcp'])
+
+
+class Cursor:
+    # Same placeholder style and error type whichever backend is underneath.
+    # Statements are timed as query_<label>, so the timing report shows
+    # which call site the database time went to.
+    def __init__(self, db, cur, label=None):
+        self.db = db
+        self.cur = cur
+        self.phase = 'query' if label is None else 'query_' + label
+
+    def execute(self, query, params=None):
+        try:
+            with METRICS.timed(self.phase):
+                if params:
+                    self.cur.execute(self.db.placeholders(query), params)
+                else:
+                    self.cur.execute(query)
+        except self.db.errors as err:
+            raise DBError(err) from err
+
+    def executemany(self, query, seq):
+        try:
+            with METRICS.timed(self.phase):
+                self.cur.executemany(self.db.placeholders(query), seq)
+        except self.db.errors as err:
+            raise DBError(err) from err
+
+    def fetchone(self):
+        try:
+            return self.cur.fetchone()
+        except self.db.errors as err:
+            raise DBError(err) from err
+
+    def fetchmany(self, size):
+        try:
+            with METRICS.timed('fetch'):
+                rows = self.cur.fetchmany(size)
+        except self.db.errors as err:
+            raise DBError(err) from err
+        METRICS.count('rows_read', len(rows))
+        return rows
+
+    def fetchall(self):
+        try:
+            return self.cur.fetchall()
+        except self.db.errors as err:
+            raise DBError(err) from err
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+    def close(self):
+        self.cur.close()
+
+
+class MySQLBackend:
+    name = 'mysql'
+    # Row locks on the free list, see claim_free_ip().
+    lock_clause = ' for update skip locked'
+    # Waits for the row instead, see take_publish_lock().
+    row_lock = ' for update'
+    SCHEMA = ["""create table if not exists hms_ip(
+    host varchar(32) unique
+    , mac varchar(12) unique
+    , ip int unsigned not null unique
+    , descr varchar(256)
+    , dhcp enum('Y', 'N')
+    , index hms_ip_free (host, ip)
+    , index hms_ip_dhcp (dhcp, ip)
+)""", """create table if not exists hms_cname(
+    cname varchar(32) unique
+    , host varchar(255)
+)""", SUBNET_TABLE, CHANGE_TABLE,
+        "insert ignore into hms_change values (1, 0)", PUBLISH_TABLE,
+        "insert ignore into hms_publish (id, pending) values (1, 0)"]
+
+    def __init__(self, host, port, user, db, pwd):
+        import mysql.connector
+        self.errors = mysql.connector.Error
+        try:
+            self.cnx = mysql.connector.connect(host=host, port=port, user=user, database=db, password=pwd)
+        except mysql.connector.Error as err:
+            raise DBError(err) from err
+
+    def placeholders(self, query):
+        return query
+
+    def cursor(self, buffered=None, label=None):
+        if buffered is None:
+            return Cursor(self, self.cnx.cursor(), label)
+        return Cursor(self, self.cnx.cursor(buffered=buffered), label)
+
+    def ping(self):
+        # The server drops connections idle for longer than wait_timeout.
+        try:
+            self.cnx.ping(reconnect=True, attempts=1, delay=0)
+        except self.errors as err:
+            raise DBError(err) from err
+
+    def begin_write(self):
+        # locking reads take care of this.
+        pass
+
+    def begin_snapshot(self):
+        try:
+            self.cnx.start_transaction(consistent_snapshot=True, readonly=True)
+        except self.errors as err:
+            raise DBError(err) from err
+
+    def commit(self):
+        try:
+            self.cnx.commit()
+        except self.errors as err:
+            raise DBError(err) from err
+
+    def rollback(self):
+        try:
+            self.cnx.rollback()
+        except self.errors as err:
+            raise DBError(err) from err
+
+    def close(self):
+        self.cnx.close()
+
+
+class SQLiteBackend:
+    name = 'sqlite'
+    # Writers are serialized by BEGIN IMMEDIATE instead.
+    lock_clause = ''
+    row_lock = ''
+    # Names and MACs compare without case, as with MySQL's default collation,
+    # so the unique indexes refuse the same duplicates on both.
+    SCHEMA = ["""create table if not exists hms_ip(
+    host varchar(32) collate nocase unique
+    , mac varchar(12) collate nocase unique
+    , ip int unsigned not null unique
+    , descr varchar(256)
+    , dhcp varchar(1) default 'N' check (dhcp in ('Y', 'N'))
+)""", "create index if not exists hms_ip_free on hms_ip (host, ip)",
+        "create index if not exists hms_ip_dhcp on hms_ip (dhcp, ip)", """create table if not exists hms_cname(
+    cname varchar(32) collate nocase
+    , host varchar(255)
+)""", "create unique index if not exists hms_cname_cname on hms_cname (cname collate nocase)",
+        SUBNET_TABLE, CHANGE_TABLE,
+        "insert or ignore into hms_change values (1, 0)", PUBLISH_TABLE,
+        "insert or ignore into hms_publish (id, pending) values (1, 0)"]
+
+    def __init__(self, path):
+        import sqlite3
+        self.errors = sqlite3.Error
+        try:
+            # the daemon hands connections between threads, one at a time.
+            self.cnx = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.cnx.execute('pragma journal_mode=wal')
+            self.cnx.execute('pragma synchronous=normal')
+            for stmt in self.SCHEMA:
+                self.cnx.execute(stmt)
+            self.cnx.commit()
+        except sqlite3.Error as err:
+            raise DBError(err) from err
+
+    def placeholders(self, query):
+        return query.replace('%s', '?')
+
+    def cursor(self, buffered=None, label=None):
+        return Cursor(self, self.cnx.cursor(), label)
+
+    def ping(self):
+        # A local file, nothing to time out.
+        pass
+
+    def begin_write(self):
+        try:
+            if not self.cnx.in_transaction:
+                self.cnx.execute('begin immediate')
+        except self.errors as err:
+            raise DBError(err) from err
+
+    def begin_snapshot(self):
+        # In WAL mode a read transaction sees one snapshot throughout.
+        try:
+            if not self.cnx.in_transaction:
+                self.cnx.execute('begin')
+        except self.errors as err:
+            raise DBError(err) from err
+
+    def commit(self):
+        try:
+            self.cnx.commit()
+        except self.errors as err:
+            raise DBError(err) from err
+
+    def rollback(self):
+        try:
+            self.cnx.rollback()
+        except self.errors as err:
+            raise DBError(err) from err
+
+    def close(self):
+        self.cnx.close()
+
+
+class Settings:
+    # Everything hms takes from the config file, read once. The BIND and
+    # DHCP sections are only checked when publishing.
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Configuration file '{path}' not found.")
+        config = configparser.ConfigParser()
+        config.read(path)
+        self.config = config
+
+        # Backend is chosen in the DEFAULT section, mysql unless told otherwise.
+        self.backend = config.get('DEFAULT', 'Backend', fallback='mysql').lower()
+        self.dbpath = config.get('DEFAULT', 'Path', fallback=DBPATH)
+        self.dbhost = None
+        self.dbport = None
+        self.dbuser = None
+        self.dbname = None
+        self.dbpass = None
+        if self.backend == 'mysql':
+            self.dbhost = config.get('DEFAULT', 'Host')
+            self.dbport = config.getint('DEFAULT', 'Port')
+            self.dbuser = config.get('DEFAULT', 'User')
+            self.dbname = config.get('DEFAULT', 'DB')
+            self.dbpass = config.get('DEFAULT', 'Pwd')
+        elif self.backend != 'sqlite':
+            raise configparser.Error(f'Unknown backend {self.backend}')
+
+        self.socket = config.get('DAEMON', 'Socket', fallback=SOCKET)
+        self.pool = config.getint('DAEMON', 'Pool', fallback=POOL)
+        self.socket_mode = int(config.get('DAEMON', 'SocketMode', fallback='600'), 8)
+
+        self.poll = config.getfloat('WATCH', 'Poll', fallback=POLL)
+        self.debounce = config.getfloat('WATCH', 'Debounce', fallback=DEBOUNCE)
+        self.maxdelay = config.getfloat('WATCH', 'MaxDelay', fallback=self.debounce * 6)
+        self.mininterval = config.getfloat('WATCH', 'MinInterval', fallback=MININTERVAL)
+        self.metrics = config.get('WATCH', 'MetricsFile', fallback=None)
+
+        self.lock_timeout = config.getint('PUBLISH', 'LockTimeout', fallback=LOCKTIMEOUT)
+        self.textfile_dir = config.get('METRICS', 'TextfileDir', fallback=None)
+
+        # -L and -F read a local copy when there is a [CACHE] section.
+        self.cache_path = config.get('CACHE', 'Path', fallback=None)
+        self.cache_ttl = config.getfloat('CACHE', 'TTL', fallback=CACHETTL)
+
+        self.bind = config.has_section('BIND')
+        self.dhcp = config.has_section('DHCP')
+
+
+def connect_db(settings):
+    if settings.backend == 'sqlite':
+        return SQLiteBackend(settings.dbpath)
+    return MySQLBackend(settings.dbhost, settings.dbport, settings.dbuser, settings.dbname, settings.dbpass)
 
 
 def check_host_inuse(cnx, host):
+    cur = cnx.cursor(label='lookup')
+    cur.execute("SELECT ip FROM hms_ip WHERE host = %s ", (host,))
+    return cur.fetchone() is not None
+
+
+def check_ip_inuse(cnx, ip):
+    cur = cnx.cursor(label='lookup')
+    cur.execute("SELECT host FROM hms_ip WHERE ip = %s and host is not null", (ip2int(ip),))
+    return cur.fetchone() is not None
+
+def perform_select(cnx, query, label=None):
     try:
-        cur = cnx.cursor()
-        cur.execute("SELECT ip FROM hms_ip WHERE host = %s ", (host,))
-        cur.fetchone()
-        return True if cur.rowcount > 0 else False
-    except mysql.connector.Error as err:
-        print('MySQL error: {}'.format(err))
+        cur = cnx.cursor(label=label)
+        # Execute a query
+        cur.execute(query)
+        return cur
+    except DBError as err:
+        print('Database error: {}'.format(err))
         bail()
 
 
-def check_cname_inuse(cnx, cname):
+def iter_rows(cnx, query, params=(), label=None):
+    # Unbuffered cursor, rows are pulled from the server as they are consumed.
+    cur = cnx.cursor(buffered=False, label=label)
+    cur.execute(query, params)
+    while True:
+        rows = cur.fetchmany(1000)
+        if not rows:
+            break
+        yield from rows
+    cur.close()
+
+
+def stream_select(cnx, query, params=(), label=None):
     try:
-        cur = cnx.cursor()
-        cur.execute("SELECT ip FROM hms_cname WHERE cname = %s ", (cname,))
-        cur.fetchone()
-        return True if cur.rowcount > 0 else False
-    except mysql.connector.Error as err:
-        print('MySQL error: {}'.format(err))
+        yield from iter_rows(cnx, query, params, label)
+    except DBError as err:
+        print('Database error: {}'.format(err))
         bail()
 
 
-def check_ip_inuse(cnx, ip):
+def bump_changes(cnx, count):
+    # Called inside the writing transaction, so the counter moves exactly
+    # when the change is committed.
+    if count <= 0:
+        return
     try:
-        cur = cnx.cursor()
-        cur.execute("SELECT host FROM hms_ip WHERE ip = %s and host is not null", (ip,))
-        cur.fetchone()
-        return True if cur.rowcount > 0 else False
-    except mysql.connector.Error as err:
-        print('MySQL error: {}'.format(err))
-        bail()
+        cur = cnx.cursor(label='counter')
+        cur.execute('update hms_change set counter = counter + %s where id = 1', (count,))
+    except DBError as err:
+        print(f'Warning: change counter not updated ({err}). Run hms --migrate.')
 
-def perform_select(cnx, query):
+
+def get_changes(cnx):
     try:
-        cur = cnx.cursor()
-        # Execute a query
-        cur.execute(query)
-        return cur
-    except mysql.connector.Error as err:
-        print('MySQL error: {}'.format(err))
+        cur = cnx.cursor(label='counter')
+        cur.execute('SELECT counter from hms_change where id = 1')
+        row = cur.fetchone()
+        # end the read, or the next one would see the same snapshot.
+        cnx.commit()
+        return row[0] if row is not None else 0
+    except DBError as err:
+        print('Database error: {}'.format(err))
         bail()
 
 
-def perform_update(cnx, query):
+def unique_column(err):
+    # Which unique index a failed write ran into, from either backend's
+    # message: "Duplicate entry 'x' for key 'hms_ip.mac'" or
+    # "UNIQUE constraint failed: hms_ip.mac".
+    m = UNIQUEFAIL.search(str(err))
+    if m is None:
+        return None
+    return m.group(1) or m.group(2)
+
+
+def subnet_range(subnet):
+    return int(subnet.network_address), int(subnet.broadcast_address)
+
+
+def claim_free_ip(cnx, subnet=None):
+    # Lock the lowest free address (optionally inside subnet) until the
+    # caller commits. Rows another session holds are skipped, not waited on,
+    # and the (host, ip) index keeps this from scanning the pool.
+    query = 'SELECT ip FROM hms_ip WHERE host is null'
+    params = ()
+    if subnet is not None:
+        query += ' and ip between %s and %s'
+        params = subnet_range(subnet)
+    query += ' order by ip limit 1' + cnx.lock_clause
+    cnx.begin_write()
+    cur = cnx.cursor(label='claim')
+    cur.execute(query, params)
+    row = cur.fetchone()
+    return int2ip(row[0]) if row is not None else None
+
+
+# Local copy of the tables for -L and -F, and what it was copied from.
+CACHE_TABLE = """create table if not exists hms_cache(
+    id int primary key
+    , counter bigint not null
+    , fetched real not null
+    , source varchar(255) not null
+)"""
+
+
+def cache_source(settings):
+    # So one cache file is never mistaken for a copy of another database.
+    if settings.backend == 'sqlite':
+        return 'sqlite:' + os.path.abspath(settings.dbpath)
+    return f'mysql:{settings.dbhost}:{settings.dbport}/{settings.dbname}'
+
+
+def load_cache(cnx, cache, source):
+    # Copy hms_ip, hms_cname and hms_subnet from one snapshot, and the
+    # counter as it stood in that snapshot.
+    cnx.begin_snapshot()
+    cur = cnx.cursor(label='cache_load')
+    cur.execute('SELECT counter from hms_change where id = 1')
+    row = cur.fetchone()
+    counter = row[0] if row is not None else 0
+    cache.begin_write()
+    ccur = cache.cursor(label='cache_write')
+    for table, cols in (('hms_ip', 'host, mac, ip, descr, dhcp'), ('hms_cname', 'cname, host'),
+                        ('hms_subnet', 'first, last, bits, descr')):
+        ccur.execute(f'delete from {table}')
+        marks = ', '.join(['%s'] * (cols.count(',') + 1))
+        ccur.executemany(f'insert into {table} ({cols}) values ({marks})',
+                         iter_rows(cnx, f'SELECT {cols} from {table}', label='cache_load'))
+    ccur.execute('insert or replace into hms_cache values (1, %s, %s, %s)', (counter, time.time(), source))
+    cache.commit()
+    cnx.commit()
+    METRICS.count('cache_loads')
+
+
+def open_cache(cnx, settings, invalidate=False):
+    # The local copy, reloaded first if the change counter has moved since
+    # it was taken, it is older than the TTL, or it was asked to be. Checking
+    # is one single-row query; None means use the database after all.
+    source = cache_source(settings)
+    cache = None
     try:
-        cur = cnx.cursor()
-        cur.execute(query)
-        cnx.commit()
-        affected_rows = cur.rowcount
-        if affected_rows > 0:
-            print(f"{affected_rows} record(s) updated successfully.")
-        else:
-            print("No records were updated, and that's kinda weird.")
-    except mysql.connector.Error as err:
-        print('MySQL error: {}'.format(err))
+        with METRICS.timed('cache'):
+            os.makedirs(os.path.dirname(os.path.abspath(settings.cache_path)), exist_ok=True)
+            cache = SQLiteBackend(settings.cache_path)
+            cur = cache.cursor(label='cache_check')
+            cur.execute(CACHE_TABLE)
+            cur.execute('SELECT counter, fetched, source from hms_cache where id = 1')
+            row = cur.fetchone()
+            cache.commit()
+            cur = cnx.cursor(label='counter')
+            cur.execute('SELECT counter from hms_change where id = 1')
+            current = cur.fetchone()
+            cnx.commit()
+            current = current[0] if current is not None else 0
+            if (invalidate or row is None or row[0] != current or row[2] != source
+                    or not 0 <= time.time() - row[1] < settings.cache_ttl):
+                load_cache(cnx, cache, source)
+            else:
+                METRICS.count('cache_hits')
+        return cache
+    except (DBError, OSError) as err:
+        print(f'Warning: not using the cache at {settings.cache_path}: {err}', file=sys.stderr)
+        for db in (cache, cnx):
+            try:
+                if db is not None:
+                    db.rollback()
+            except DBError:
+                pass
+        if cache is not None:
+            cache.close()
+        return None
+
+
+def check_arg(pattern, value, msg):
+    if value is not None and not pattern.match(value):
+        raise UsageError(value + msg)
+    return value
+
+
+def clean_mac(mac):
+    if mac is None:
+        return None
+    return check_arg(MACVALID, mac.replace(':', '').replace('-', '').replace('.', '').lower(),
+                     ' is not a valid MAC address')
+
+
+def clean_subnet(subnet):
+    if subnet is None or isinstance(subnet, ipaddress.IPv4Network):
+        return subnet
+    try:
+        net = ipaddress.ip_network(subnet)
+    except ValueError:
+        net = None
+    if net is None or net.version != 4:
+        raise UsageError(str(subnet) + ' is not a valid IPv4 subnet')
+    return net
+
+
+def address_ranges(spec):
+    # "a.b.c.d", "a.b.c.d-a.b.c.e" or a CIDR, comma separated, as
+    # inclusive (first, last) pairs.
+    if spec is None:
+        return []
+    items = spec.split(',') if isinstance(spec, str) else spec
+    ranges = []
+    for item in items:
+        item = str(item).strip()
+        try:
+            if '-' in item:
+                lo, hi = (ip2int(part.strip()) for part in item.split('-', 1))
+            elif '/' in item:
+                lo, hi = subnet_range(ipaddress.ip_network(item, strict=False))
+            else:
+                lo = hi = ip2int(item)
+        except ValueError:
+            raise UsageError(item + ' is not a valid address, range or subnet') from None
+        if lo > hi:
+            raise UsageError(item + ' is not a valid address range')
+        ranges.append((lo, hi))
+    return ranges
+
+
+def yes_no(flag):
+    # True/False or the Y/N the table and the CLI use.
+    if flag is None or isinstance(flag, bool):
+        return flag
+    if isinstance(flag, str):
+        return flag.upper().startswith('Y')
+    return bool(flag)
+
+
+class HMS:
+    # Everything the command line does, for Python callers. One connection
+    # is kept for the life of the object. Methods return Host tuples,
+    # addresses and counts, and raise HMSError subclasses instead of
+    # printing and exiting. Each call is its own transaction; the *_many
+    # variants write a whole batch in one, and nothing if any entry fails.
+    def __init__(self, config=None, cnx=None, settings=None):
+        if settings is None and (cnx is None or config is not None):
+            settings = Settings(config or CONFIG)
+        self.settings = settings
+        self.own = cnx is None
+        self.cnx = connect_db(settings) if cnx is None else cnx
+        self.changes = 0
+
+    def close(self):
+        if self.own:
+            self.cnx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def commit(self):
+        bump_changes(self.cnx, self.changes)
+        self.changes = 0
+        self.cnx.commit()
+
+    def rollback(self):
+        self.changes = 0
+        try:
+            self.cnx.rollback()
+        except DBError:
+            pass
+
+    def write(self, query, params, inuse=None):
+        # Nothing is looked up first, the unique indexes refuse conflicts.
+        try:
+            cur = self.cnx.cursor(label='write')
+            cur.execute(query, params)
+        except DBError as err:
+            column = unique_column(err)
+            if inuse is not None and column in inuse:
+                raise InUseError(INUSE[column] % inuse[column]) from err
+            raise
+        self.changes += max(cur.rowcount, 0)
+        return cur.rowcount
+
+    def one(self, fn, *args):
+        try:
+            result = fn(*args)
+            self.commit()
+        except BaseException:
+            self.rollback()
+            raise
+        return result
+
+    def many(self, fn, entries):
+        # entries are argument tuples or keyword dicts for fn.
+        results = []
+        try:
+            for i, entry in enumerate(entries):
+                try:
+                    results.append(fn(**entry) if isinstance(entry, dict) else fn(*entry))
+                except HMSError as err:
+                    raise BatchError(i, err) from err
+            self.commit()
+        except BaseException:
+            self.rollback()
+            raise
+        return results
+
+    def add(self, host, ip=None, mac=None, desc=None, dhcp=False, subnet=None):
+        return self.one(self._add, host, ip, mac, desc, dhcp, subnet)
+
+    def add_many(self, entries):
+        return self.many(self._add, entries)
+
+    def _add(self, host, ip=None, mac=None, desc=None, dhcp=False, subnet=None):
+        if host is None:
+            raise UsageError('No host name specified.')
+        check_arg(HOSTVALID, host, ' is not a valid host name')
+        check_arg(IPVALID, ip, ' is not a valid IPv4 address')
+        check_arg(DESCVALID, desc, ' is not a valid description')
+        mac = clean_mac(mac)
+        subnet = clean_subnet(subnet)
+        dhcp = yes_no(dhcp) or False
+        if mac is None and dhcp:
+            raise UsageError('Cannot use DHCP without a mac!')
+        if ip is None:
+            ip = claim_free_ip(self.cnx, subnet)
+            if ip is None:
+                raise NoFreeIPError('No free IPs available.' if subnet is None
+                                    else 'No free IPs available in %s.' % subnet)
+        elif subnet is not None and ipaddress.ip_address(ip) not in subnet:
+            raise UsageError('IP %s is not in %s.' % (ip, subnet))
+
+        query = "update hms_ip set host=%s, mac=%s, descr=%s, dhcp=%s where ip=%s and host is null"
+        params = (host, mac, desc, 'Y' if dhcp else 'N', ip2int(ip))
+        if self.write(query, params, {'host': host, 'mac': mac}) == 0:
+            # only a failed add pays for finding out why.
+            if check_ip_inuse(self.cnx, ip):
+                raise InUseError('IP %s is already in use.' % ip)
+            raise NotFoundError('IP %s is not in the pool.' % ip)
+        return Host(host, ip, mac, desc, dhcp)
+
+    def modify(self, host, desc=None, mac=None, dhcp=None):
+        return self.one(self._modify, host, desc, mac, dhcp)
+
+    def modify_many(self, entries):
+        return self.many(self._modify, entries)
+
+    def _modify(self, host, desc=None, mac=None, dhcp=None):
+        # Returns the number of rows changed, 0 if they already matched.
+        if host is None:
+            raise UsageError('No host name specified.')
+        check_arg(HOSTVALID, host, ' is not a valid host name')
+        check_arg(DESCVALID, desc, ' is not a valid description')
+        mac = clean_mac(mac)
+        dhcp = yes_no(dhcp)
+        if desc is None and mac is None and dhcp is None:
+            raise UsageError('What do you want to modify?')
+
+        sets = []
+        params = []
+        for column, value in (('mac', mac), ('descr', desc), ('dhcp', None if dhcp is None else 'YN'[not dhcp])):
+            if value is not None:
+                sets.append(column + '=%s')
+                params.append(value)
+        query = 'update hms_ip set ' + ', '.join(sets) + ' where host=%s'
+        params.append(host)
+        count = self.write(query, tuple(params), {'mac': mac})
+        if count == 0 and not check_host_inuse(self.cnx, host):
+            raise NotFoundError('Host %s does not exist.' % host)
+        return count
+
+    def delete(self, ip=None, host=None):
+        return self.one(self._delete, ip, host)
+
+    def delete_many(self, entries):
+        return self.many(self._delete, entries)
+
+    def _delete(self, ip=None, host=None):
+        # Returns the address given back to the pool.
+        if (ip is None) == (host is None):
+            raise UsageError('Must specify either ip or host.')
+        check_arg(IPVALID, ip, ' is not a valid IPv4 address')
+        check_arg(HOSTVALID, host, ' is not a valid host name')
+        if ip is None:
+            # the address is needed for the answer anyway.
+            cur = self.cnx.cursor(label='lookup')
+            cur.execute('SELECT ip from hms_ip where host = %s', (host,))
+            row = cur.fetchone()
+            if row is None:
+                raise NotFoundError('Host %s does not exist.' % host)
+            ip = int2ip(row[0])
+        query = "update hms_ip set host=null, descr=null, mac=null, dhcp='N' where ip=%s and host is not null"
+        if self.write(query, (ip2int(ip),)) == 0:
+            raise NotFoundError('IP %s is not in use.' % ip)
+        return ip
+
+    def cname(self, cname, host):
+        return self.one(self._cname, cname, host)
+
+    def _cname(self, cname, host):
+        # The target is either an entry here, a bare host name that must
+        # exist, or a fully qualified name elsewhere, stored as given.
+        if cname is None or host is None:
+            raise UsageError('No host name or CNAME target specified.')
+        check_arg(FQDNVALID, cname, ' is not a valid target FQDN')
+        host = host.rstrip('.')
+        if '.' in host:
+            check_arg(FQDNVALID, host, ' is not a valid target FQDN')
+            self.write("insert into hms_cname (cname, host) values (%s, %s)", (cname, host), {'cname': cname})
+            return
+        check_arg(HOSTVALID, host, ' is not a valid host name')
+        # The unique index on cname does the rest.
+        query = "insert into hms_cname (cname, host) select %s, host from hms_ip where host = %s"
+        if self.write(query, (cname, host), {'cname': cname}) == 0:
+            raise NotFoundError('Host %s does not exist.' % host)
+
+    def rename(self, host, newhost):
+        return self.one(self._rename, host, newhost)
+
+    def _rename(self, host, newhost):
+        if host is None or newhost is None:
+            raise UsageError('No old name or new name specified.')
+        check_arg(HOSTVALID, host, ' is not a valid host name')
+        check_arg(HOSTVALID, newhost, ' is not a valid host name')
+        query = "update hms_ip set host=%s where host=%s"
+        if self.write(query, (newhost, host), {'host': newhost}) == 0:
+            raise NotFoundError('Host %s does not exist.' % host)
+
+    def rename_cname(self, cname, newcname):
+        return self.one(self._rename_cname, cname, newcname)
+
+    def _rename_cname(self, cname, newcname):
+        if cname is None or newcname is None:
+            raise UsageError('No old CNAME or new CNAME specified.')
+        check_arg(FQDNVALID, cname, ' is not a valid target FQDN')
+        check_arg(FQDNVALID, newcname, ' is not a valid target FQDN')
+        query = "update hms_cname set cname=%s where cname=%s"
+        if self.write(query, (newcname, cname), {'cname': newcname}) == 0:
+            raise NotFoundError('CNAME %s does not exist.' % cname)
+
+    def add_subnet(self, subnet, desc=None, exclude=None, force=False):
+        return self.one(self._add_subnet, subnet, desc, exclude, force)
+
+    def _add_subnet(self, subnet, desc=None, exclude=None, force=False):
+        # Returns the number of free addresses added. Every address in the
+        # subnet gets a row except the network and broadcast addresses, the
+        # excluded ones, and any already in hms_ip. Anything bigger than a
+        # /MINPREFIX is most likely a typo, so it takes force.
+        subnet = clean_subnet(subnet)
+        if subnet is None:
+            raise UsageError('No subnet specified.')
+        check_arg(DESCVALID, desc, ' is not a valid description')
+        if subnet.prefixlen < MINPREFIX and not force:
+            raise UsageError(f'{subnet} is larger than a /{MINPREFIX}; use --force if that is intended.')
+        if (subnet.is_multicast or subnet.is_loopback or subnet.is_link_local or subnet.is_reserved
+                or subnet.is_unspecified):
+            raise UsageError(f'{subnet} is a reserved network.')
+        skip = address_ranges(exclude)
+        first, last = subnet_range(subnet)
+        lo, hi = (first + 1, last - 1) if subnet.prefixlen < 31 else (first, last)
+
+        self.cnx.begin_write()
+        cur = self.cnx.cursor(label='subnet')
+        cur.execute('SELECT first, bits from hms_subnet where first <= %s and last >= %s' + self.cnx.row_lock,
+                    (last, first))
+        row = cur.fetchone()
+        if row is not None:
+            raise InUseError(f'Subnet {subnet} overlaps {int2ip(row[0])}/{row[1]}.')
+        self.write('insert into hms_subnet (first, last, bits, descr) values (%s, %s, %s, %s)',
+                   (first, last, subnet.prefixlen, desc))
+        cur.execute('SELECT ip from hms_ip where ip between %s and %s', (first, last))
+        have = {row[0] for row in cur.fetchall()}
+
+        # Many rows per statement, so a /16 is a few hundred round trips.
+        count = 0
+        batch = []
+        for ip in range(lo, hi + 1):
+            if ip in have or any(a <= ip <= b for a, b in skip):
+                continue
+            batch.append(ip)
+            if len(batch) == INSERTBATCH:
+                count += self.write('insert into hms_ip (ip, dhcp) values ' +
+                                    ', '.join(["(%s, 'N')"] * len(batch)), tuple(batch))
+                batch = []
+        if batch:
+            count += self.write('insert into hms_ip (ip, dhcp) values ' +
+                                ', '.join(["(%s, 'N')"] * len(batch)), tuple(batch))
+        return count
+
+    def retire_subnet(self, subnet):
+        return self.one(self._retire_subnet, subnet)
+
+    def _retire_subnet(self, subnet):
+        # Returns the number of free addresses removed. Nothing is removed
+        # while any address in the subnet is assigned.
+        subnet = clean_subnet(subnet)
+        if subnet is None:
+            raise UsageError('No subnet specified.')
+        first, last = subnet_range(subnet)
+        self.cnx.begin_write()
+        # Delete first and then count what is left, so an address claimed
+        # meanwhile is either deleted free or counted as assigned.
+        removed = self.write('delete from hms_ip where ip between %s and %s and host is null', (first, last))
+        cur = self.cnx.cursor(label='subnet')
+        cur.execute('SELECT count(*) from hms_ip where ip between %s and %s', (first, last))
+        used = cur.fetchone()[0]
+        if used:
+            raise InUseError(f'{used} address(es) in {subnet} are still assigned.')
+        subnets = self.write('delete from hms_subnet where first between %s and %s and last <= %s',
+                             (first, last, last))
+        if removed == 0 and subnets == 0:
+            raise NotFoundError(f'Subnet {subnet} is not in the pool.')
+        return removed
+
+    def list(self, ip=None, host=None, subnet=None, like=None, dhcp=None, has_mac=None, desc=None,
+             limit=None, after=None):
+        # Host tuples in address order, streamed from the server; read them
+        # to the end before the next call on this object.
+        if ip is not None and host is not None:
+            raise UsageError('Must specify either ip or host - not both.')
+        check_arg(IPVALID, ip, ' is not a valid IPv4 address')
+        check_arg(HOSTVALID, host, ' is not a valid host name')
+        check_arg(HOSTGLOB, like, ' is not a valid host name pattern')
+        check_arg(DESCVALID, desc, ' is not a valid description')
+        where = ['host is not null']
+        params = []
+        if ip is not None:
+            where.append('ip = %s')
+            params.append(ip2int(ip))
+        elif host is not None:
+            where.append('host = %s')
+            params.append(host)
+        if like is not None:
+            # shell style glob on the name; a plain prefix uses the host index.
+            where.append("host like %s escape '!'")
+            params.append(like.replace('*', '%').replace('?', '_'))
+        if yes_no(dhcp) is not None:
+            where.append('dhcp = %s')
+            params.append('Y' if yes_no(dhcp) else 'N')
+        if yes_no(has_mac) is not None:
+            where.append('mac is not null' if yes_no(has_mac) else 'mac is null')
+        if desc is not None:
+            where.append("descr like %s escape '!'")
+            params.append('%' + like_escape(desc) + '%')
+        query, params = list_query('SELECT host, ip, mac, descr, dhcp from hms_ip', where, params,
+                                   clean_subnet(subnet), limit, after)
+        return (Host(row[0], int2ip(row[1]), row[2], row[3], row[4] == 'Y')
+                for row in self.read(query, params, 'list'))
+
+    def free(self, subnet=None, limit=None, after=None):
+        # Free addresses in order, streamed like list().
+        query, params = list_query('SELECT ip from hms_ip', ['host is null'], [], clean_subnet(subnet), limit, after)
+        return (int2ip(row[0]) for row in self.read(query, params, 'free'))
+
+    def read(self, query, params, label):
+        # Ends the read when the rows run out or the caller stops early, or
+        # MySQL would keep serving later reads from the same snapshot.
+        try:
+            yield from iter_rows(self.cnx, query, params, label)
+        finally:
+            try:
+                self.cnx.commit()
+            except DBError:
+                self.rollback()
+
+    def publish(self, force=False):
+        # Progress is still reported on stdout, as for -P.
+        if self.settings is None or (not self.settings.bind and not self.settings.dhcp):
+            raise ConfigError('No BIND or DHCP section found.')
+        try:
+            return locked_publish(self.cnx, self.settings, force)
+        except BaseException:
+            self.rollback()
+            raise
+
+
+def cli_call(code, fn, *args, **kw):
+    # The command line side of the API: usage for bad arguments, the
+    # message and exit code for anything refused.
+    try:
+        return fn(*args, **kw)
+    except ConfigError as err:
+        print(f'Configuration error: {err}')
+        config_bind_dhcp_usage()
+    except UsageError as err:
+        usage(str(err))
+    except DBError as err:
+        print('Database error: {}'.format(err))
         bail()
+    except HMSError as err:
+        print(err)
+        sys.exit(code)
 
 
-def do_add(cnx, ip, host, desc, mac, dhcp):
-    # mac is optional.
-    if mac is None and dhcp == 'Y':
-        usage('Cannot use DHCP without a mac!')
+def cli_rows(rows):
+    try:
+        yield from rows
+    except DBError as err:
+        print('Database error: {}'.format(err))
+        bail()
 
-    # mac must not already exist.
-    if mac is not None and check_mac_inuse(cnx, mac):
-        print('MAC %s is already in use.' % mac)
-        sys.exit(3)
 
-    # host is required and unique.
-    if host is None:
-        usage('No host name specified.')
-    elif check_host_inuse(cnx, host):
-        print('Host %s is already in use.' % host)
-        sys.exit(3)
+def do_add(cnx, ip, host, desc, mac, dhcp, subnet=None):
+    entry = cli_call(3, HMS(cnx=cnx).add, host, ip, mac, desc, dhcp, subnet)
 
     # desc is optional, but recommended.
     if desc is None:
@@ -179,166 +1262,593 @@ def do_add(cnx, ip, host, desc, mac, dhcp):
     # if you cannot afford and IP, one will be provided for you.
     if ip is None:
         print('No IP specified. Using next available.')
-        try:
-            cur = cnx.cursor()
-            cur.execute('SELECT ip FROM hms_ip WHERE host is null limit 1')
-            ip = cur.fetchone()[0]
-            if cur.rowcount == 0:
-                print('No free IPs available.')
-                sys.exit(3)
-            print('Using free IP: {}'.format(ip))
-        except mysql.connector.Error as err:
-            print('MySQL error: {}'.format(err))
-            bail()
-    elif check_ip_inuse(cnx, ip):
-        print('IP %s is already in use.' % ip)
-        sys.exit(3)
-
-    # let's get this query together now.
-    query = "update hms_ip set host='%s'" % host
-    if mac is not None:
-        query += ",mac='%s'" % mac
-    if desc is not None:
-        query += ",descr='%s'" % desc
-    if dhcp is not None:
-        query += ",dhcp='%s'" % dhcp
-    query += " where ip='%s'" % ip
-
-    # ok, let's add this thing...
-    #print(query)
-    perform_update(cnx, query)
+        print('Using free IP: {}'.format(entry.ip))
+    print('1 record(s) updated successfully.')
 
 
 def do_cname(cnx, cname, host) :
-    if cname is None or host is None:
-        usage('No host name or CNAME target specified.')
-    # any other checks needed here? This seems too easy.
-    query = "insert into hms_cname (cname, host) values (%s, %s)" % (cname, host)
-    perform_update(cnx, query)
+    cli_call(3, HMS(cnx=cnx).cname, cname, host)
+    print('1 record(s) updated successfully.')
 
 
 def do_rename_host(cnx, host, newhost):
-    if host is None or newhost is None:
-        usage('No old name or new name specified.')
-        sys.exit(3)
-    if not check_host_inuse(cnx, host):
-        usage('Host %s does not exist.' % host)
-        sys.exit(3)
-
-    query = "update hms_ip set host='%s' where host='%s'" % (newhost, host)
-    perform_update(cnx, query)
+    cli_call(3, HMS(cnx=cnx).rename, host, newhost)
+    print('1 record(s) updated successfully.')
 
 
 def do_rename_cname(cnx, cname, newcname):
-    if cname is None or newcname is None:
-        usage('No old CNAME or new CNAME specified.')
-        sys.exit(3)
-    if not check_cname_inuse(cnx, cname):
-        usage('CNAME %s does not exist.' % cname)
-        sys.exit(3)
-
-    query = "update hms_cname set cname='%s' where cname='%s'" % (newcname, cname)
-    perform_update(cnx, query)
+    cli_call(3, HMS(cnx=cnx).rename_cname, cname, newcname)
+    print('1 record(s) updated successfully.')
 
 
 def do_modify(cnx, host, desc, mac, dhcp):
-    if host is None:
-        usage('No host name specified.')
-    if desc is None and mac is None and dhcp is None:
-        usage('What do you want to modify?')
-    if check_mac_inuse(cnx, mac):
-        print('MAC %s is already in use.' % mac)
-        sys.exit(6)
-
-    query = 'update hms_ip set '
-    if mac is not None:
-        query += "mac='%s'" % mac
-    elif desc is not None:
-        query += "descr='%s'" % desc
-    elif dhcp is not None:
-        query += "dhcp='%s'" % dhcp
-    query += " where host='%s'" % host
-    perform_update(cnx, query)
+    count = cli_call(6, HMS(cnx=cnx).modify, host, desc, mac, dhcp)
+    if count > 0:
+        print(f"{count} record(s) updated successfully.")
+    else:
+        print("No records were updated, and that's kinda weird.")
 
 
 def do_delete(cnx, ip, host):
-    # Mst provide one or the other.
-    if (ip is None and host is None) or (ip is not None and host is not None):
-        print('Must specify either ip or host.')
-        sys.exit(5)
-    # IP in use?
-    if ip is not None and not check_ip_inuse(cnx, ip):
-        print('IP %s is not in use.' % ip)
-        sys.exit(5)
-    # host in use?
-    if host is not None and not check_host_inuse(cnx, host):
-        print('Host %s does not exist.' % host)
-        sys.exit(5)
-    # get the ip if we only have the host
-    if ip is None and host is not None:
-        query = "select ip from hms_ip where host='%s'" % host
-        try:
-            cur = cnx.cursor()
-            cur.execute(query)
-            ip = cur.fetchone()
-        except mysql.connector.Error as err:
-            print('MySQL error: {}'.format(err))
-            bail()
+    cli_call(5, HMS(cnx=cnx).delete, ip, host)
+    print('1 record(s) updated successfully.')
+
+
+def do_add_subnet(cnx, subnet, desc, exclude, force):
+    count = cli_call(3, HMS(cnx=cnx).add_subnet, subnet, desc, exclude, force)
+    print(f'Subnet {subnet} added with {count} free address(es).')
+
 
-    query = "update hms_ip set host=null, descr=null, mac=null, dhcp='N' where ip='%s' and host is not null" % ip
-    #print(query)
-    perform_update(cnx, query)
+def do_retire_subnet(cnx, subnet):
+    count = cli_call(5, HMS(cnx=cnx).retire_subnet, subnet)
+    print(f'Subnet {subnet} retired, {count} free address(es) removed.')
 
 
-def do_list(cnx, ip, host):
-    if ip is not None and host is not None:
-        print('Must specify either ip or host - not both.')
-        sys.exit(4)
-    if ip is None and host is None:
-        query = 'select host, ip, mac, descr, dhcp from hms_ip where host is not null'
+def format_mac(mac):
+    return ":".join([mac[i:i + 2] for i in range(0, 12, 2)]) if mac is not None else None
+
+
+class RowWriter:
+    # Rows straight to stdout, one at a time, for -L and -F with --format.
+    def __init__(self, fmt, fields, widths):
+        self.fmt = fmt
+        self.fields = fields
+        self.out = sys.stdout
+        if fmt in ('csv', 'tsv'):
+            import csv
+            self.csv = csv.writer(self.out, delimiter=',' if fmt == 'csv' else '\t', lineterminator='\n')
+            self.csv.writerow(fields)
+        elif fmt == 'table':
+            # widths are known from the schema, so nothing has to be read ahead.
+            cols = [f'{{:<{w}}}' for w in widths] + ['{}'] * (len(fields) - len(widths))
+            self.line = ' '.join(cols) + '\n'
+            self.out.write(self.line.format(*[f.upper() for f in fields]))
+
+    def write(self, values):
+        if self.fmt == 'json':
+            self.out.write(json.dumps(dict(zip(self.fields, values))) + '\n')
+        elif self.fmt == 'table':
+            self.out.write(self.line.format(*['-' if v is None else v for v in values]))
+        else:
+            self.csv.writerow(['' if v is None else v for v in values])
+
+
+def list_query(select, where, params, subnet, limit, after):
+    # Pages are keyed on the address, so each one is an index range scan
+    # starting after the last address of the previous page, not an OFFSET.
+    check_arg(IPVALID, after, ' is not a valid IPv4 address')
+    if limit is not None and (not isinstance(limit, int) or limit < 1):
+        raise UsageError(f'{limit} is not a valid limit')
+    if subnet is not None:
+        where.append('ip between %s and %s')
+        params.extend(subnet_range(subnet))
+    if after is not None:
+        where.append('ip > %s')
+        params.append(ip2int(after))
+    query = select + ' where ' + ' and '.join(where) + ' order by ip'
+    if limit is not None:
+        query += ' limit %d' % limit
+    return query, tuple(params)
+
+
+def like_escape(text):
+    return text.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+
+def do_list(cnx, ip, host, subnet=None, fmt='text', filters=None, limit=None, after=None):
+    filters = filters or {}
+    rows = cli_call(4, HMS(cnx=cnx).list, ip, host, subnet, filters.get('host'), filters.get('dhcp'),
+                    filters.get('mac'), filters.get('desc'), limit, after)
+    if fmt != 'text':
+        out = RowWriter(fmt, ['host', 'ip', 'mac', 'dhcp', 'descr'], [32, 15, 17, 4])
+        for h in cli_rows(rows):
+            out.write((h.host, h.ip, format_mac(h.mac), 'Y' if h.dhcp else 'N', h.descr))
+        return
+    count = 0
+    last = None
+    for h in cli_rows(rows):
+        count += 1
+        last = h.ip
+        print('Host ', h.host)
+        print('IP   ', h.ip)
+        print('MAC  ', format_mac(h.mac) or "NO MAC PROVIDED")
+        print('Desc ', h.descr)
+        print('DHCP ', 'Y' if h.dhcp else 'N', '\n')
+    if limit is not None and count == limit:
+        print(f'More entries may follow, continue with --after {last}')
+
+
+def do_freelist(cnx, subnet=None, fmt='text', limit=None, after=None):
+    rows = cli_call(4, HMS(cnx=cnx).free, subnet, limit, after)
+    if fmt != 'text':
+        out = RowWriter(fmt, ['ip'], [])
+        for ip in cli_rows(rows):
+            out.write((ip,))
+        return
+    print('Free list...')
+    total = 0
+    last = None
+    for ip in cli_rows(rows):
+        print(f'FREE: {ip}')
+        total += 1
+        last = ip
+    print('\nTotal free IPs is', total)
+    if limit is not None and total == limit:
+        print(f'More free IPs may follow, continue with --after {last}')
+
+
+def do_free_ranges(cnx, subnet=None, fmt='text'):
+    # Runs of consecutive free addresses, folded in the database: within
+    # a run, ip minus its row number is the same.
+    where = 'host is null'
+    params = ()
+    if subnet is not None:
+        where += ' and ip between %s and %s'
+        params = subnet_range(subnet)
+    query = ('SELECT min(ip), max(ip), count(*) from (SELECT ip, cast(ip as signed) - row_number() over '
+             '(order by ip) as run from hms_ip where ' + where + ') runs group by run order by 1')
+    out = RowWriter(fmt, ['first', 'last', 'free', 'cidrs'], [15, 15, 8]) if fmt != 'text' else None
+    if out is None:
+        print('Free ranges...')
+    total = 0
+    for first, last, count in stream_select(cnx, query, params, 'free'):
+        cidrs = ' '.join(str(n) for n in ipaddress.summarize_address_range(
+            ipaddress.IPv4Address(first), ipaddress.IPv4Address(last)))
+        total += count
+        if out is not None:
+            out.write((int2ip(first), int2ip(last), count, cidrs))
+        else:
+            print(f'{int2ip(first):<15} - {int2ip(last):<15} {count:>8}  {cidrs}')
+    if out is None:
+        print('\nTotal free IPs is', total)
+
+
+def do_free_summary(cnx, subnet=None, fmt='text', threshold=None):
+    # Used and free per subnet, counted by the database. Without any
+    # subnets in hms_subnet, every /24 in the pool is one.
+    params = ()
+    where = ''
+    if subnet is not None:
+        params = subnet_range(subnet)
+    cur = perform_select(cnx, 'SELECT count(*) from hms_subnet', 'summary')
+    if cur.fetchone()[0] > 0:
+        if subnet is not None:
+            where = ' where s.first between %s and %s'
+        query = ("SELECT s.first, s.bits, s.descr, count(i.ip), "
+                 "coalesce(sum(case when i.host is null then 1 else 0 end), 0) from hms_subnet s "
+                 "left join hms_ip i on i.ip between s.first and s.last" + where +
+                 " group by s.first, s.bits, s.descr order by s.first")
     else:
-        query = 'select host, ip, mac, descr, dhcp from hms_ip where '
-        if ip is not None:
-            query += "ip = '%s'" % ip
+        if subnet is not None:
+            where = ' where ip between %s and %s'
+        query = ("SELECT ip & 4294967040, 24, null, count(*), "
+                 "sum(case when host is null then 1 else 0 end) from hms_ip" + where +
+                 " group by ip & 4294967040 order by 1")
+
+    out = RowWriter(fmt, ['subnet', 'pool', 'used', 'free', 'used_pct', 'descr'], [18, 8, 8, 8, 8]) \
+        if fmt != 'text' else None
+    if out is None:
+        print(f"{'SUBNET':<18} {'POOL':>8} {'USED':>8} {'FREE':>8} {'USED%':>7}  DESCR")
+    full = []
+    totals = [0, 0]
+    for first, bits, descr, pool, free in stream_select(cnx, query, params, 'summary'):
+        net = f'{int2ip(first)}/{bits}'
+        pool = int(pool)
+        free = int(free)
+        used = pool - free
+        pct = round(100.0 * used / pool, 1) if pool else None
+        totals[0] += pool
+        totals[1] += free
+        over = threshold is not None and pct is not None and pct >= threshold
+        if over:
+            full.append(net)
+        if out is not None:
+            out.write((net, pool, used, free, pct, descr))
         else:
-            query += "host = '%s'" % host
+            mark = ' !' if over else ''
+            print(f"{net:<18} {pool:>8} {used:>8} {free:>8} {'-' if pct is None else pct:>7}  {descr or ''}{mark}")
+    if out is None:
+        pool, free = totals
+        pct = round(100.0 * (pool - free) / pool, 1) if pool else '-'
+        print(f"{'Total':<18} {pool:>8} {pool - free:>8} {free:>8} {pct:>7}")
+    if full:
+        if out is None:
+            print(f'\n{len(full)} subnet(s) at or above {threshold}% used: ' + ', '.join(full))
+        sys.exit(7)
+
+
+def lease_time(stmt):
+    # "cltt 4 2026/10/15 12:00:00" in UTC, "cltt epoch 1760529600" with
+    # db-time-format local, or "... never".
+    import calendar
+    words = stmt.split(';', 1)[0].split()
     try:
-        cur = cnx.cursor()
-        cur.execute(query)
-        for row in cur:
-            if row is None:
-                if ip is not None and host is not None:
-                    print('No entry found with %s or %s' % (ip, host))
+        if words[1] == 'epoch':
+            return int(words[2])
+        date, clock = words[2], words[3]
+        return calendar.timegm((int(date[:4]), int(date[5:7]), int(date[8:10]),
+                                int(clock[:2]), int(clock[3:5]), int(clock[6:8]), 0, 0, 0))
+    except (IndexError, ValueError):
+        return None
+
+
+def iter_leases(file):
+    # (ip, mac, seen, state, client) per IPv4 lease block, read a line at a
+    # time with as little work per line as possible. Other blocks (lease6,
+    # failover, host) are skipped whole.
+    depth = 0
+    lease = None
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        if lease is not None:
+            if line.startswith('hardware ethernet '):
+                lease[1] = line[18:].split(';', 1)[0].replace(':', '').lower()
+            elif line.startswith('cltt '):
+                lease[2] = line
+            elif line.startswith('starts '):
+                lease[3] = line
+            elif line.startswith('binding state '):
+                lease[4] = line[14:].split(';', 1)[0]
+            elif line.startswith('client-hostname '):
+                lease[5] = line[16:].rsplit(';', 1)[0].strip('"')
+            elif line[0] == '}':
+                depth -= 1
+                if depth == 0:
+                    ip, mac, cltt, starts, state, client = lease
+                    lease = None
+                    # cltt is the last time the client talked to the server.
+                    yield ip, mac, lease_time(cltt or starts) if cltt or starts else None, state, client
+            elif line.endswith('{'):
+                depth += 1
+            continue
+        if line[0] == '#':
+            continue
+        if line.endswith('{'):
+            depth += 1
+            words = line.split()
+            if depth == 1 and words[0] == 'lease' and IPVALID.match(words[1]):
+                lease = [words[1], None, None, None, None, None]
+        elif line[0] == '}':
+            depth -= 1
+
+
+def do_reconcile(cnx, path, subnet=None, fmt='text', filters=None, days=STALEDAYS):
+    # Compare hms_ip with what dhcpd has actually handed out. The table is
+    # read once into dicts, then the lease file is streamed past them.
+    # Later blocks for an address replace earlier ones, as in dhcpd, so
+    # memory grows with the number of addresses, not the size of the file.
+    filters = filters or {}
+    query = 'SELECT host, ip, mac, dhcp from hms_ip where host is not null'
+    params = ()
+    if subnet is not None:
+        query += ' and ip between %s and %s'
+        params = subnet_range(subnet)
+    by_ip = {}
+    by_mac = {}
+    for host, ip, mac, dhcp in stream_select(cnx, query, params, 'reconcile'):
+        mac = mac.lower() if mac else None
+        by_ip[ip] = (host, mac, dhcp)
+        if mac:
+            by_mac[mac] = (host, ip, dhcp)
+
+    first, last = subnet_range(subnet) if subnet is not None else (0, 2 ** 32 - 1)
+    ip_lease = {}
+    mac_lease = {}
+    try:
+        with METRICS.timed('leases'), (sys.stdin if path == '-' else open(path, 'r', errors='replace')) as file:
+            for ip, mac, seen, state, client in iter_leases(file):
+                METRICS.count('leases_read')
+                ip = ip2int(ip)
+                if not first <= ip <= last:
+                    continue
+                lease = (ip, mac, seen, state, client)
+                ip_lease[ip] = lease
+                if mac and (mac not in mac_lease or (seen or 0) >= (mac_lease[mac][2] or 0)):
+                    mac_lease[mac] = lease
+    except OSError as err:
+        print(f'Cannot read lease file {path}: {err}')
+        sys.exit(8)
+
+    cutoff = time.time() - days * 86400
+    found = []
+    # Entries with a MAC that has not had a lease within days.
+    for ip, (host, mac, dhcp) in by_ip.items():
+        if not mac or (filters.get('dhcp') and dhcp != filters['dhcp']):
+            continue
+        seen = mac_lease[mac][2] if mac in mac_lease else None
+        if seen is None or seen < cutoff:
+            found.append(('stale', host, ip, mac, None, None, seen, None))
+    for lip, mac, seen, state, client in mac_lease.values():
+        if seen is None or seen < cutoff:
+            continue
+        if mac not in by_mac:
+            found.append(('unknown', None, None, None, lip, mac, seen, client))
+        elif state == 'active' and by_mac[mac][1] != lip:
+            host, ip, dhcp = by_mac[mac]
+            found.append(('mismatch', host, ip, mac, lip, mac, seen, client))
+    # Addresses currently leased to a MAC no entry has, but held by an
+    # entry with another one.
+    for lip, lmac, seen, state, client in ip_lease.values():
+        if state != 'active' or not lmac or lip not in by_ip or lmac in by_mac:
+            continue
+        host, mac, dhcp = by_ip[lip]
+        if mac != lmac:
+            found.append(('mismatch', host, lip, mac, lip, lmac, seen, client))
+    found.sort(key=lambda f: (f[0], f[2] if f[2] is not None else f[4]))
+
+    def stamp(seen):
+        return datetime.fromtimestamp(seen).strftime('%Y-%m-%d %H:%M') if seen is not None else None
+
+    if fmt != 'text':
+        out = RowWriter(fmt, ['status', 'host', 'ip', 'mac', 'lease_ip', 'lease_mac', 'seen', 'client'],
+                        [8, 32, 15, 17, 15, 17, 16])
+        for status, host, ip, mac, lip, lmac, seen, client in found:
+            out.write((status, host, int2ip(ip) if ip is not None else None, format_mac(mac),
+                       int2ip(lip) if lip is not None else None, format_mac(lmac), stamp(seen), client))
+    else:
+        titles = {'stale': f'Entries with no lease in {days:g} days', 'unknown': 'MACs not in hms',
+                  'mismatch': 'Leases that disagree with hms'}
+        for status in ('stale', 'unknown', 'mismatch'):
+            rows = [f for f in found if f[0] == status]
+            if not rows:
+                continue
+            print(f'{titles[status]} ({len(rows)}):')
+            for _, host, ip, mac, lip, lmac, seen, client in rows:
+                if status == 'stale':
+                    print(f"  {host:<32} {int2ip(ip):<15} {format_mac(mac):<17} {stamp(seen) or 'never'}")
+                elif status == 'unknown':
+                    print(f"  {format_mac(lmac):<17} {int2ip(lip):<15} {stamp(seen)}  {client or ''}")
                 else:
-                    t = ip if ip is not None else host
-                    print('No entry found with %s' % t)
+                    print(f"  {host:<32} {int2ip(ip):<15} {format_mac(mac) or '-':<17} leased "
+                          f"{int2ip(lip)} to {format_mac(lmac)} {stamp(seen)}")
+        print(f'{len(by_ip)} entries, {len(ip_lease)} leased addresses, {len(found)} difference(s).')
+    if found:
+        sys.exit(7)
+
+
+def load_snapshot(cnx):
+    # One pass over each table so bulk rows can be checked in memory. Names
+    # are keyed in lower case, as the unique indexes compare them.
+    snap = {'ips': {}, 'hosts': {}, 'macs': {}, 'cnames': set(), 'free': {}}
+    cur = perform_select(cnx, 'SELECT host, ip, mac from hms_ip order by ip', 'bulk')
+    for host, ip, mac in cur:
+        ip = int2ip(ip)
+        mac = mac.lower() if mac is not None else None
+        snap['ips'][ip] = host
+        if host is None:
+            snap['free'][ip] = None
+        else:
+            snap['hosts'][host.lower()] = mac
+        if mac is not None:
+            snap['macs'][mac] = host.lower()
+    cur = perform_select(cnx, 'SELECT cname from hms_cname where cname is not null', 'bulk')
+    for row in cur:
+        snap['cnames'].add(row[0].lower())
+    return snap
+
+
+def check_bulk_row(snap, row):
+    # Returns (mode, values) for a good row or raises the HMSError the
+    # HMS method for that mode would, checked with the same validators.
+    row = [f.strip() for f in row] + [''] * (6 - len(row))
+    mode, host, ip, mac, desc, dhcp = [f if f != '' else None for f in row[:6]]
+    mode = (mode or '').upper()
+    if mode not in ('A', 'M'):
+        raise UsageError('mode must be A or M')
+    if host is None:
+        raise UsageError('No host name specified.')
+    check_arg(HOSTVALID, host, ' is not a valid host name')
+    check_arg(IPVALID, ip, ' is not a valid IPv4 address')
+    check_arg(DESCVALID, desc, ' is not a valid description')
+    mac = clean_mac(mac)
+    if dhcp is not None:
+        dhcp = dhcp.upper()
+        if dhcp not in ('Y', 'N'):
+            raise UsageError('DHCP must be Y or N')
+    key = host.lower()
+    if mac is not None and snap['macs'].get(mac, key) != key:
+        raise InUseError(INUSE['mac'] % mac)
+
+    if mode == 'A':
+        if dhcp is None:
+            dhcp = 'N'
+        if mac is None and dhcp == 'Y':
+            raise UsageError('Cannot use DHCP without a mac!')
+        if mac is not None and mac in snap['macs']:
+            raise InUseError(INUSE['mac'] % mac)
+        if key in snap['hosts'] or key in snap['cnames']:
+            raise InUseError(INUSE['host'] % host)
+        if ip is None:
+            if not snap['free']:
+                raise NoFreeIPError('No free IPs available.')
+            ip = next(iter(snap['free']))
+        elif ip not in snap['ips']:
+            raise NotFoundError('IP %s is not in the pool.' % ip)
+        elif snap['ips'][ip] is not None:
+            raise InUseError(INUSE['ip'] % ip)
+        # claim it so later rows see this one.
+        del snap['free'][ip]
+        snap['ips'][ip] = host
+        snap['hosts'][key] = mac
+        if mac is not None:
+            snap['macs'][mac] = key
+        return mode, (host, mac, desc, dhcp, ip2int(ip))
+
+    if key not in snap['hosts']:
+        raise NotFoundError('Host %s does not exist.' % host)
+    if desc is None and mac is None and dhcp is None:
+        raise UsageError('What do you want to modify?')
+    if dhcp == 'Y' and mac is None and snap['hosts'][key] is None:
+        raise UsageError('Cannot use DHCP without a mac!')
+    if mac is not None:
+        snap['macs'].pop(snap['hosts'][key], None)
+        snap['macs'][mac] = key
+        snap['hosts'][key] = mac
+    return mode, (mac, desc, dhcp, host)
+
+
+def do_bulk(cnx, infile, atomic):
+    # Rows are: mode,host,ip,mac,description,dhcp where mode is A or M.
+    # Empty fields are skipped, lines starting with # are comments.
+    try:
+        file = sys.stdin if infile is None or infile == '-' else open(infile, 'r', newline='')
+    except OSError as err:
+        print(f'Cannot read {infile}: {err}')
+        sys.exit(3)
+
+    snap = load_snapshot(cnx)
+    adds = []
+    mods = []
+    errors = []
+    import csv
+    with file:
+        for lineno, row in enumerate(csv.reader(file), 1):
+            if not row or not ''.join(row).strip() or row[0].lstrip().startswith('#'):
+                continue
+            try:
+                mode, values = check_bulk_row(snap, row)
+            except HMSError as err:
+                errors.append((lineno, str(err)))
+                continue
+            if mode == 'A':
+                adds.append(values)
             else:
-                print('Host ', row[0])
-                print('IP   ', row[1])
-                if row[2] is not None:
-                    formatted_mac = ":".join([row[2][i:i + 2] for i in range(0, 12, 2)])
-                else:
-                    formatted_mac = "NO MAC PROVIDED"
-                print('MAC  ', formatted_mac)
-                print('Desc ', row[3])
-                print('DHCP ', row[4], '\n')
-    except mysql.connector.Error as err:
-        print('MySQL error: {}'.format(err))
+                mods.append(values)
+
+    for lineno, msg in errors:
+        print(f'Line {lineno}: {msg}')
+
+    if errors and atomic:
+        print(f'{len(errors)} row(s) rejected. No changes made.')
+        sys.exit(3)
+
+    try:
+        cur = cnx.cursor(label='bulk')
+        if adds:
+            cur.executemany("update hms_ip set host=%s, mac=%s, descr=%s, dhcp=%s "
+                            "where ip=%s and host is null", adds)
+            if cur.rowcount != len(adds):
+                # somebody else claimed an address since the snapshot.
+                cnx.rollback()
+                print('Pool changed during import. No changes made, try again.')
+                sys.exit(3)
+        if mods:
+            cur.executemany("update hms_ip set mac=coalesce(%s, mac), descr=coalesce(%s, descr), "
+                            "dhcp=coalesce(%s, dhcp) where host=%s", mods)
+        bump_changes(cnx, len(adds) + len(mods))
+        cnx.commit()
+    except DBError as err:
+        cnx.rollback()
+        print('Database error: {}'.format(err))
+        print('No changes made.')
         bail()
 
+    print(f'{len(adds)} added, {len(mods)} modified, {len(errors)} rejected.')
+    if errors:
+        sys.exit(3)
 
-def do_freelist(cnx):
-    print('Free list...')
+
+def do_migrate_sqlite(cnx):
+    # Databases made before names and MACs compared without case get
+    # indexes that do. Fails, changing nothing, if there are duplicates.
+    # Also adds hms_publish.forced to databases made before it.
     try:
-        cur = cnx.cursor()
-        # Execute a query
-        cur.execute('SELECT ip from hms_ip where host is null')
-        for row in cur:
-            # Access data by index (e.g., row[0], row[1])
-            print(f'FREE: {row[0]}')
-        print('\nTotal free IPs is', cur.rowcount)
-    except mysql.connector.Error as err:
-        print('MySQL error: {}'.format(err))
+        cnx.begin_write()
+        cur = cnx.cursor(label='migrate')
+        cur.execute('create unique index if not exists hms_ip_host_nocase on hms_ip (host collate nocase)')
+        cur.execute('create unique index if not exists hms_ip_mac_nocase on hms_ip (mac collate nocase)')
+        cur.execute('create unique index if not exists hms_cname_nocase on hms_cname (cname collate nocase)')
+        cur.execute('pragma table_info(hms_publish)')
+        if 'forced' not in [row[1] for row in cur.fetchall()]:
+            cur.execute('alter table hms_publish add forced int not null default 0')
+            print('Column hms_publish.forced added.')
+        cnx.commit()
+        print('Host, MAC and CNAME indexes ignore case.')
+    except DBError as err:
+        print('Database error: {}'.format(err))
+        print('Rename hosts or CNAMEs, or change MACs, that differ only in case, then run --migrate again.')
+        bail()
+
+
+def do_migrate(cnx):
+    # Addresses become int unsigned in place, so the existing unique index
+    # on ip carries over and range scans use it. Safe to run again.
+    if cnx.name != 'mysql':
+        do_migrate_sqlite(cnx)
+        return
+    try:
+        cur = cnx.cursor(label='migrate')
+        cur.execute("SELECT data_type FROM information_schema.columns WHERE table_schema = database() "
+                    "and table_name = 'hms_ip' and column_name = 'ip'")
+        row = cur.fetchone()
+        dtype = row[0].decode() if isinstance(row[0], (bytes, bytearray)) else row[0]
+        if dtype.lower() == 'varchar':
+            cur.execute('update hms_ip set ip = inet_aton(ip)')
+            print(f'{cur.rowcount} address(es) converted.')
+            cur.execute('alter table hms_ip modify ip int unsigned not null')
+        else:
+            print('Addresses are already numeric.')
+
+        # Every /24 already in the pool becomes a subnet.
+        cur.execute(SUBNET_TABLE)
+        cur.execute('insert ignore into hms_subnet (first, last, bits) '
+                    'select distinct ip & 4294967040, ip | 255, 24 from hms_ip')
+        print(f'{cur.rowcount} subnet(s) added.')
+        cur.execute(CHANGE_TABLE)
+        cur.execute('insert ignore into hms_change values (1, 0)')
+        cur.execute(PUBLISH_TABLE)
+        cur.execute('insert ignore into hms_publish (id, pending) values (1, 0)')
+        cur.execute("SELECT count(*) FROM information_schema.columns WHERE table_schema = database() "
+                    "and table_name = 'hms_publish' and column_name = 'forced'")
+        if cur.fetchone()[0] == 0:
+            cur.execute('alter table hms_publish add forced int not null default 0')
+            print('Column hms_publish.forced added.')
+
+        # For the free IP allocator's locking claim.
+        cur.execute("SELECT count(*) FROM information_schema.statistics WHERE table_schema = database() "
+                    "and table_name = 'hms_ip' and index_name = 'hms_ip_free'")
+        if cur.fetchone()[0] == 0:
+            cur.execute('create index hms_ip_free on hms_ip (host, ip)')
+            print('Index hms_ip_free added.')
+
+        # For -L --dhcp.
+        cur.execute("SELECT count(*) FROM information_schema.statistics WHERE table_schema = database() "
+                    "and table_name = 'hms_ip' and index_name = 'hms_ip_dhcp'")
+        if cur.fetchone()[0] == 0:
+            cur.execute('create index hms_ip_dhcp on hms_ip (dhcp, ip)')
+            print('Index hms_ip_dhcp added.')
+
+        # Duplicate CNAMEs are refused by this index, not a lookup first.
+        cur.execute("SELECT count(*) FROM information_schema.statistics WHERE table_schema = database() "
+                    "and table_name = 'hms_cname' and column_name = 'cname' and non_unique = 0")
+        if cur.fetchone()[0] == 0:
+            cur.execute('alter table hms_cname add unique (cname)')
+            print('Unique index on hms_cname.cname added.')
+        cnx.commit()
+    except DBError as err:
+        print('Database error: {}'.format(err))
         bail()
 
 
@@ -347,62 +1857,353 @@ def do_version():
     sys.exit(0)
 
 
-def do_bind_publish(cnx, config):
-    #
-    # Get publish data from /etc/hms.ini
-    #
-    bhost = None
-    bnlist = None
-    bkey = None
-    # FIXME - Multiple forward zones?
-    bfwdzone = None
-    bfwdname = None
-    # Allow multiple reverse zones.
-    brevzone = []
-    brevname = []
-    brevwild = []
-    buser = None
-    bport = None
-    bdom = None
-
-    # Get options from ini.
-    try:
-        # Config already established
-        bhost = config.get('BIND', 'Host')
-        bnlist = config.get('BIND', 'NSList')
-        bkey = config.get('BIND', 'Key')
-        f = config.get('BIND', 'FwdZoneDestName')
-        bfwdzone = f.split(',')[0]
-        bfwdname = f.split(',')[1]
-        rev = config.get('BIND', 'RevZoneDestName').split(':')
-        for r in rev:
-            parts = r.split(',')
-            brevzone.append(parts[0])
-            brevname.append(parts[1])
-            if len(parts) > 2:
-                brevwild.append(parts[2])
+class ZoneFile:
+    # One output file being streamed, fingerprinted as it is written.
+    # The serial changes every minute, so leave it out of the fingerprint.
+    def __init__(self, tmpdir, name, header, hosts):
+        import hashlib
+        self.path = os.path.join(tmpdir, name)
+        self.hash = hashlib.sha256(','.join(sorted(hosts)).encode())
+        self.hash.update(SERIALLINE.sub('', header).encode())
+        self.file = open(self.path, 'w')
+        self.file.write(header)
+
+    def write(self, line):
+        self.file.write(line)
+        self.hash.update(line.encode())
+
+    def close(self):
+        METRICS.count('bytes_written', self.file.tell())
+        self.file.close()
+        return self.hash.hexdigest()
+
+
+class ZoneCheck:
+    # Checks the rendered zone files here, before anything is pushed:
+    # record syntax, label rules, duplicates, CNAMEs sharing a name with
+    # other data, and PTRs whose target has no matching A record. Files are
+    # read a line at a time; only the records' names and data are kept.
+    LABEL = re.compile(r'^[A-Za-z0-9_-]{1,63}$')
+    # RFC 952/1123 host names, as named's check-names.
+    HOSTLABEL = re.compile(r'^[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?$')
+    # Whole absolute names in one match; labels are only looked at one by
+    # one to say what is wrong.
+    NAMEVALID = re.compile(r'^(?:\*\.)?(?:[A-Za-z0-9_-]{1,63}\.)+$')
+    HOSTVALID = re.compile(r'^(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+$')
+    TTLVALID = re.compile(r'^(?:\d+[SMHDWsmhdw]?)+$')
+    TYPEVALID = re.compile(r'^(?:[A-Z][A-Z0-9-]*|TYPE\d+)$')
+    CLASSES = ('IN', 'CH', 'HS')
+    NAMEDATA = ('CNAME', 'PTR', 'NS', 'DNAME')
+    # How many fields each type takes, where that is fixed.
+    FIELDS = {'A': 1, 'AAAA': 1, 'CNAME': 1, 'PTR': 1, 'NS': 1, 'DNAME': 1, 'MX': 2, 'SRV': 4, 'SOA': 7}
+    LIMIT = 20
+
+    def __init__(self):
+        self.zones = []
+        self.addresses = {}
+        self.ptrs = []
+        self.errors = []
+        self.warnings = []
+
+    def error(self, zone, lineno, msg):
+        self.errors.append(f'{zone}:{lineno}: {msg}')
+
+    def warn(self, zone, lineno, msg):
+        self.warnings.append(f'{zone}:{lineno}: warning: {msg}')
+
+    def name(self, name, origin):
+        if name == '@':
+            return origin
+        return name.lower() if name.endswith('.') else f'{name}.{origin}'.lower()
+
+    def bad_name(self, name, host=False):
+        # Why name is not a valid (host) name, or None.
+        if len(name) > 254:
+            return 'name too long'
+        # a leading * label makes a wildcard, whatever the record type.
+        if host and name.startswith('*.'):
+            name = name[2:]
+        if (self.HOSTVALID if host else self.NAMEVALID).match(name):
+            return None
+        labels = name.rstrip('.').split('.')
+        for i, label in enumerate(labels):
+            if label == '*' and i == 0:
+                continue
+            if not (self.HOSTLABEL if host else self.LABEL).match(label):
+                return f'bad {"host name" if host else "label"} "{label}"'
+        return 'bad name'
+
+    def lines(self, file):
+        # (line number, text) per entry, comments removed and parenthesized
+        # continuations joined.
+        held = None
+        start = 0
+        for lineno, line in enumerate(file, 1):
+            if ';' in line:
+                if '"' in line:
+                    quoted = False
+                    for i, ch in enumerate(line):
+                        if ch == '"':
+                            quoted = not quoted
+                        elif ch == ';' and not quoted:
+                            line = line[:i]
+                            break
+                else:
+                    line = line.split(';', 1)[0]
+            line = line.rstrip()
+            if held is not None:
+                held += ' ' + line
+                if ')' in line:
+                    yield start, held.replace('(', ' ').replace(')', ' ')
+                    held = None
+                continue
+            if '(' in line and ')' not in line:
+                held = line
+                start = lineno
+                continue
+            if line.strip():
+                yield lineno, line.replace('(', ' ').replace(')', ' ')
+        if held is not None:
+            yield start, held + ' ('
+
+    def check(self, zone, path):
+        apex = zone.lower().rstrip('.') + '.'
+        self.zones.append(apex)
+        origin = apex
+        owner = None
+        # owner -> [(type, data)], so the first record of a name, which is
+        # nearly every record, costs one dict lookup.
+        records = {}
+        with open(path, 'r') as file:
+            for lineno, line in self.lines(file):
+                words = line.split()
+                if words[0][0] == '$':
+                    if words[0] == '$TTL' and (len(words) != 2 or not self.TTLVALID.match(words[1])):
+                        self.error(zone, lineno, 'bad $TTL')
+                    elif words[0] == '$ORIGIN':
+                        origin = self.name(words[1], origin) if len(words) == 2 else origin
+                    elif words[0] not in ('$TTL', '$INCLUDE', '$GENERATE'):
+                        # named may know it even if this does not.
+                        self.warn(zone, lineno, f'unknown directive {words[0]}, not checked')
+                    continue
+                if line.endswith(' ('):
+                    self.error(zone, lineno, 'unbalanced parentheses')
+                    continue
+                i = 0
+                if not line[0].isspace():
+                    i = 1
+                    owner = self.name(words[0], origin)
+                    # a host name is always a valid name.
+                    host = bool(self.HOSTVALID.match(owner)) or self.bad_name(owner, True) is None
+                    why = None if host else self.bad_name(owner)
+                    if why:
+                        self.error(zone, lineno, f'{owner}: {why}')
+                    elif owner != apex and not owner.endswith('.' + apex):
+                        self.error(zone, lineno, f'{owner} is not in the zone')
+                elif owner is None:
+                    self.error(zone, lineno, 'record without an owner')
+                    continue
+                # optional TTL and class, in either order.
+                while i < len(words) and (words[i] == 'IN' or words[i].upper() in self.CLASSES
+                                          or words[i][0].isdigit() and self.TTLVALID.match(words[i])):
+                    i += 1
+                rtype = words[i].upper() if i < len(words) else ''
+                if rtype not in self.FIELDS and not self.TYPEVALID.match(rtype):
+                    self.error(zone, lineno, f'{owner}: no record type')
+                    continue
+                data = words[i + 1:]
+                self.record(zone, lineno, apex, origin, owner, host, rtype, data)
+
+                have = records.get(owner)
+                if have is None:
+                    records[owner] = [(rtype, data)]
+                    continue
+                # Same name, other data.
+                types = {t for t, d in have}
+                if any(t == rtype and [x.lower() for x in d] == [x.lower() for x in data] for t, d in have):
+                    self.error(zone, lineno, f'{owner}: duplicate {rtype} record')
+                elif rtype == 'CNAME':
+                    self.error(zone, lineno, f'{owner}: CNAME and other data')
+                elif 'CNAME' in types:
+                    self.error(zone, lineno, f'{owner}: {rtype} and CNAME')
+                elif rtype in ('PTR', 'SOA') and rtype in types:
+                    self.error(zone, lineno, f'{owner}: more than one {rtype}')
+                have.append((rtype, data))
+        types = {t for t, d in records.get(apex, ())}
+        if 'SOA' not in types:
+            self.error(zone, 0, 'no SOA record')
+        if 'NS' not in types:
+            self.error(zone, 0, 'no NS records')
+
+    def target(self, zone, lineno, owner, rtype, name, origin, host=True):
+        name = self.name(name, origin)
+        why = self.bad_name(name, host)
+        if why:
+            self.error(zone, lineno, f'{owner} {rtype}: {why}')
+        return name
+
+    def record(self, zone, lineno, apex, origin, owner, host, rtype, data):
+        if (rtype in self.FIELDS and len(data) != self.FIELDS[rtype]) or not data:
+            self.error(zone, lineno, f'{owner}: {rtype} needs {self.FIELDS.get(rtype, 1)} field(s)')
+            return
+        if rtype in ('A', 'AAAA', 'MX') and not host:
+            self.error(zone, lineno, f'{owner}: {self.bad_name(owner, True)} for {rtype}')
+        if rtype == 'A':
+            if not IPVALID.match(data[0]):
+                self.error(zone, lineno, f'{owner}: bad address {data[0]}')
             else:
-                brevwild.append(None)
-        buser = config.get('BIND', 'User')
-        bport = config.get('BIND', 'Port')
-        bdom = config.get('BIND', 'Domain')
-    except (configparser.NoSectionError, configparser.NoOptionError) as e:
-        print(f"Configuration error: {e}")
-        config_bind_dhcp_usage()
-    except IndexError as e:
-        print(f"Configuration error: Check zone entries. {e}")
-        config_bind_dhcp_usage()
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        config_bind_dhcp_usage()
-
-    nslist = ''
-    for x in bnlist.split(','):
-        nslist += f'@ IN NS {x}.\n'
-
-    # Build files
-    serial = get_serial()
-    forward = f"""$TTL 5M;
+                self.addresses.setdefault(owner, set()).add(data[0])
+        elif rtype == 'AAAA':
+            try:
+                ipaddress.IPv6Address(data[0])
+            except ValueError:
+                self.error(zone, lineno, f'{owner}: bad address {data[0]}')
+        elif rtype in self.NAMEDATA:
+            name = self.target(zone, lineno, owner, rtype, data[0], origin, rtype in ('PTR', 'NS'))
+            if rtype == 'PTR':
+                self.ptrs.append((zone, lineno, owner, name))
+        elif rtype in ('MX', 'SRV'):
+            if not all(d.isdigit() and int(d) < 65536 for d in data[:-1]):
+                self.error(zone, lineno, f'{owner}: bad {rtype} numbers')
+            self.target(zone, lineno, owner, rtype, data[-1], origin, data[-1] != '.')
+        elif rtype == 'SOA':
+            if owner != apex:
+                self.error(zone, lineno, f'{owner}: SOA not at the zone apex')
+            self.target(zone, lineno, owner, rtype, data[0], origin)
+            self.target(zone, lineno, owner, rtype, data[1], origin, False)
+            if not all(self.TTLVALID.match(d) for d in data[2:]):
+                self.error(zone, lineno, f'{owner}: bad SOA numbers')
+
+    def finish(self):
+        # PTRs are checked once every zone has been read. Targets outside
+        # the zones published here cannot be checked.
+        forward = [z for z in self.zones if not z.endswith('.in-addr.arpa.')]
+        for zone, lineno, owner, name in self.ptrs:
+            labels = owner.split('.')
+            ip = '.'.join(reversed(labels[:-3])) if len(labels) == 7 else None
+            if name in self.addresses:
+                if ip is not None and ip not in self.addresses[name]:
+                    self.error(zone, lineno, f'{owner}: PTR to {name}, which has no A record for {ip}')
+            elif any(name == fwd or name.endswith('.' + fwd) for fwd in forward):
+                self.error(zone, lineno, f'{owner}: PTR to {name}, which has no A record')
+        return self.errors
+
+
+def rev_network(zone, wild):
+    # Which addresses belong in a reverse zone, and how many octets the
+    # zone name already covers.
+    labels = zone.lower().rstrip('.').split('.')
+    octets = labels[:-2][::-1] if labels[-2:] == ['in-addr', 'arpa'] else []
+    try:
+        net = ipaddress.ip_network('.'.join(octets + ['0'] * (4 - len(octets))) + f'/{8 * len(octets)}')
+    except ValueError:
+        net = None
+        octets = []
+    if wild is not None and re.match(r'^(\d+\.){1,3}%$', wild):
+        # plain octet prefix wildcard, same as a network.
+        prefix = wild.split('.')[:-1]
+        net = ipaddress.ip_network('.'.join(prefix + ['0'] * (4 - len(prefix))) + f'/{8 * len(prefix)}')
+        wild = None
+    # match is given the address as an integer and as a string.
+    match = None
+    if wild is not None:
+        # ip wildcard is an SQL LIKE pattern.
+        like = re.compile('^' + re.escape(wild).replace('%', '.*').replace('_', '.') + '$').match
+        match = lambda n, ip: like(ip)
+    elif net is not None:
+        first, last = subnet_range(net)
+        match = lambda n, ip: first <= n <= last
+    return match, len(octets) or 3
+
+
+def read_snapshot(cnx, outputs):
+    # One consistent read of both tables, handed to every output as it streams in.
+    cnx.begin_snapshot()
+    # Sorted, so unchanged data renders identically.
+    render = Phase(METRICS, 'render', None)
+    for row in stream_select(cnx, 'SELECT cname, host from hms_cname where cname is not null order by cname',
+                             label='snapshot'):
+        with render:
+            for out in outputs:
+                out.cname(row)
+    for row in stream_select(cnx, 'SELECT host, ip, mac, dhcp from hms_ip where host is not null order by ip',
+                             label='snapshot'):
+        with render:
+            for out in outputs:
+                out.host(row)
+    cnx.commit()
+
+
+class BindPublish:
+    def __init__(self, config, tmpdir, force):
+        #
+        # Get publish data from /etc/hms.ini
+        #
+        bhost = None
+        bnlist = None
+        bkey = None
+        # FIXME - Multiple forward zones?
+        bfwdzone = None
+        bfwdname = None
+        # Allow multiple reverse zones.
+        brevzone = []
+        brevname = []
+        brevwild = []
+        buser = None
+        bport = None
+        bdom = None
+        bworkers = WORKERS
+        bstate = STATE
+        bupdate = None
+        bserver = None
+        bbatch = BATCH
+        brecords = RECORDS
+        bcheck = 'named-checkzone'
+        bvalidate = True
+
+        # Get options from ini.
+        try:
+            # Config already established
+            bhost = config.get('BIND', 'Host')
+            bnlist = config.get('BIND', 'NSList')
+            bkey = config.get('BIND', 'Key')
+            f = config.get('BIND', 'FwdZoneDestName')
+            bfwdzone = f.split(',')[0]
+            bfwdname = f.split(',')[1]
+            rev = config.get('BIND', 'RevZoneDestName').split(':')
+            for r in rev:
+                parts = r.split(',')
+                brevzone.append(parts[0])
+                brevname.append(parts[1])
+                if len(parts) > 2:
+                    brevwild.append(parts[2])
+                else:
+                    brevwild.append(None)
+            buser = config.get('BIND', 'User')
+            bport = config.get('BIND', 'Port')
+            bdom = config.get('BIND', 'Domain')
+            bworkers = config.getint('BIND', 'Workers', fallback=WORKERS)
+            bstate = config.get('BIND', 'StateFile', fallback=STATE)
+            bupdate = config.get('BIND', 'Update', fallback=None)
+            bserver = config.get('BIND', 'UpdateServer', fallback=None)
+            bbatch = config.getint('BIND', 'UpdateBatch', fallback=BATCH)
+            brecords = config.get('BIND', 'RecordFile', fallback=RECORDS)
+            bcheck = config.get('BIND', 'Check', fallback='named-checkzone')
+            bvalidate = config.getboolean('BIND', 'Validate', fallback=True)
+        except (configparser.NoSectionError, configparser.NoOptionError) as e:
+            raise ConfigError(str(e)) from e
+        except IndexError as e:
+            raise ConfigError(f'Check zone entries. {e}') from e
+        except Exception as e:
+            raise ConfigError(f'An unexpected error occurred: {e}') from e
+
+        nslist = ''
+        for x in bnlist.split(','):
+            nslist += f'@ IN NS {x}.\n'
+
+        # Build files
+        serial = get_serial()
+        forward = f"""$TTL 5M;
 ;$ORIGIN	cs.skidmore.edu.
 @		IN	SOA	ns1.cs.skidmore.edu. root.cs.skidmore.edu. (
 				{serial}	; serial
@@ -414,7 +2215,7 @@ def do_bind_publish(cnx, config):
 
 """
 
-    reversefixed = f"""$TTL 5M;
+        reversefixed = f"""$TTL 5M;
 ;$ORIGIN cs.skidmore.edu.
 @               IN      SOA     localhost. root.cs.skidmore.edu. (
                                 {serial}        ; serial
@@ -427,240 +2228,974 @@ def do_bind_publish(cnx, config):
 
 """
 
-    # Get fixed content, if exists.
-    if os.path.exists(FIXED):
-        with open(FIXED, 'r') as file:
-            forward += '\n' + file.read() + '\n'
-
-    # Add CNAME records
-    cur = perform_select(cnx, 'SELECT cname, host from hms_cname where cname is not null')
-    for row in cur:
-        # cname IN CNAME target.host.dom.
-        forward += f'{row[0]} IN CNAME {row[1]}.\n'
-
-    # Add forward records
-    cur = perform_select(cnx, 'SELECT host, ip from hms_ip where host is not null')
-    for row in cur:
-        # host IN CNAME x.x.x.x
-        forward += f'{row[0]}\tIN\tA\t{row[1]}\n'
-
-    # Create forward file
-    # FIXME check for file access
-    tmpfwd = '/tmp/forward.zone'
-    with open(tmpfwd, 'w') as file:
-        file.write(forward)
-
-    # Push file to endpoint
-    for h in bhost.split(','):
-        # scp -i key {tmpfwd} h:{bfwdname}
-        # Send forward
-        cmd = f'scp -i {bkey} -P {bport} {tmpfwd} {buser}@{h}:{bfwdname}'
-        run_command(cmd)
-
-        # Test Zones.
-        cmd = f'ssh -i {bkey} -p {bport} {buser}@{h} "named-checkzone {bfwdzone} {bfwdname}"'
-        run_command(cmd)
-
-    #
-    # The REVERSE work is trickier.
-    #
-
-    for i in range(len(brevzone)):
-        reverse = reversefixed
-        add =''
-        if brevwild[i] is not None:
-            add = f" and ip like '{brevwild[i]}'"
-        query = "SELECT host, ip from hms_ip where host is not null %s" % add
-        cur = perform_select(cnx, query)
-        # Add forward and reverse records
-        for row in cur:
-            pieces =row[1].split('.')
-            # FIXME this needs to account for rev zone IP representation!
-            #reverse += f'{pieces[3]}.{pieces[2]}\tIN\tPTR\t{row[0]}.{bdom}.\n'
-            reverse += f'{pieces[3]}\tIN\tPTR\t{row[0]}.{bdom}.\n'
-
-        # Create reverse file
-        # FIXME check for file access
-        tmprev = '/tmp/reverse.zone'
-        with open(tmprev, 'w') as file:
-            file.write(reverse)
-
-        # Push files to endpoint
-        for h in bhost.split(','):
-            # scp -i key {tmpfwd} h:{bfwdname}
-            # Send reverse
-            cmd = f'scp -i {bkey} -P {bport} {tmprev} {buser}@{h}:{brevname[i]}'
-            run_command(cmd)
-
-            # Test Zones.
-            cmd = f'ssh -i {bkey} -p {bport} {buser}@{h} "named-checkzone {brevzone[i]} {brevname[i]}"'
-            run_command(cmd)
-
-
-def run_command(cmd):
-    print(f'Running command: {cmd}')
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    print(result.stdout, result.stderr, result.returncode)
-    if result.returncode != 0:
-        bail()
-
+        # Get fixed content, if exists.
+        if os.path.exists(FIXED):
+            with open(FIXED, 'r') as file:
+                forward += '\n' + file.read() + '\n'
+
+        self.hosts = bhost.split(',')
+        self.key = bkey
+        self.port = bport
+        self.user = buser
+        self.dom = bdom
+        self.workers = bworkers
+        self.statefile = bstate
+        self.force = force
+        self.update = bupdate
+        self.server = bserver
+        self.batch = max(1, bbatch)
+        self.recordfile = brecords
+        self.check = bcheck.strip()
+        self.validate = bvalidate
+        # Records are only kept when they may be sent as dynamic updates.
+        self.records = {} if bupdate else None
+        self.forward = (bfwdzone, bfwdname, ZoneFile(tmpdir, f'{bfwdzone}.zone', forward, self.hosts))
+
+        #
+        # The REVERSE work is trickier.
+        #
+        self.reverse = []
+        for i in range(len(brevzone)):
+            match, octets = rev_network(brevzone[i], brevwild[i])
+            self.reverse.append((brevzone[i], brevname[i], match, octets,
+                                 ZoneFile(tmpdir, f'{brevzone[i]}.zone', reversefixed, self.hosts)))
+        if self.records is not None:
+            self.records = {zone: set() for zone in [bfwdzone] + brevzone}
+
+    def record(self, zone, out, owner, rtype, data, sep='\t'):
+        out.write(f'{owner}{sep}IN{sep}{rtype}{sep}{data}\n')
+        if self.records is not None:
+            self.records[zone].add((f'{owner}.{zone}.', rtype, data))
+
+    def cname(self, row):
+        # cname IN CNAME target.host.dom. A bare target is one of ours.
+        target = f'{row[1]}.' if '.' in row[1] else f'{row[1]}.{self.dom}.'
+        self.record(self.forward[0], self.forward[2], row[0], 'CNAME', target, ' ')
+
+    def host(self, row):
+        ip = int2ip(row[1])
+        # host IN A x.x.x.x
+        self.record(self.forward[0], self.forward[2], row[0], 'A', ip)
+        pieces = ip.split('.')
+        for zone, name, match, octets, out in self.reverse:
+            if match is None or match(row[1], ip):
+                # owner is whatever the zone name does not already cover.
+                owner = '.'.join(reversed(pieces[octets:]))
+                self.record(zone, out, owner, 'PTR', f'{row[0]}.{self.dom}.')
+
+    def push_updates(self, last):
+        # Send only what changed since the last publish, as nsupdate
+        # transactions of at most UpdateBatch records. Deleting a missing
+        # record or adding an existing one is a no-op, so a failed run can
+        # simply be repeated.
+        zones = [self.forward[0]] + [r[0] for r in self.reverse]
+        script = ''
+        total = 0
+        for zone in zones:
+            old = set(tuple(r) for r in last.get(zone, []))
+            new = self.records.get(zone, set())
+            changes = [f'update delete {o} {t} {d}' for o, t, d in sorted(old - new)]
+            changes += [f'update add {o} {TTL} {t} {d}' for o, t, d in sorted(new - old)]
+            if not changes:
+                print(f'Zone {zone} unchanged, skipping.')
+                METRICS.count('zones_skipped')
+                continue
+            print(f'Zone {zone}: {len(changes)} update(s).')
+            total += len(changes)
+            for i in range(0, len(changes), self.batch):
+                if self.server:
+                    script += f'server {self.server}\n'
+                script += f'zone {zone}.\n' + '\n'.join(changes[i:i + self.batch]) + '\nsend\n'
+
+        if not total:
+            print('No zones changed. Nothing to publish.')
+            return
+        METRICS.count('records_updated', total)
+        with METRICS.timed('update'):
+            run_command(self.update, stdin=script)
+
+    def check_zones(self, zones):
+        # Nothing is pushed anywhere unless every zone passes.
+        checker = ZoneCheck()
+        with METRICS.timed('validate'):
+            for zone, name, out in zones:
+                checker.check(zone, out.path)
+            errors = checker.finish()
+        if checker.warnings:
+            print('\n'.join(checker.warnings[:ZoneCheck.LIMIT]))
+        if errors:
+            print('\n'.join(errors[:ZoneCheck.LIMIT]))
+            if len(errors) > ZoneCheck.LIMIT:
+                print(f'... and {len(errors) - ZoneCheck.LIMIT} more.')
+            raise PublishError(f'{len(errors)} problem(s) found in the zones. Nothing was published.')
+
+    def save_records(self):
+        save_state(self.recordfile, {zone: sorted(recs) for zone, recs in self.records.items()})
+
+    def push(self):
+        # Everything is pushed at once, skipping zones that have not
+        # changed since the last good publish.
+        state = load_state(self.statefile)
+        digests = {}
+        files = []
+        checks = []
+        zones = [(zone, name, out) for zone, name, *_, out in [self.forward] + self.reverse]
+        for zone, name, out in zones:
+            digests[name] = out.close()
+        if self.validate:
+            self.check_zones(zones)
+
+        # With an Update command, once there is a record of what was last
+        # published, only the differences are sent. --force replaces
+        # every zone file instead.
+        if self.update and not self.force:
+            last = load_state(self.recordfile)
+            if all(zone in last for zone, name, out in zones):
+                self.push_updates(last)
+                self.save_records()
+                state.update(digests)
+                save_state(self.statefile, state)
+                return
+
+        for zone, name, out in zones:
+            if self.force or state.get(name) != digests[name]:
+                files.append((out.path, name))
+                if self.check:
+                    checks.append(f'{self.check} {zone} {name}')
+            else:
+                print(f'Zone {zone} unchanged, skipping.')
+                METRICS.count('zones_skipped')
+
+        if not files:
+            print('No zones changed. Nothing to publish.')
+            # The servers already have these zones, so they are also the
+            # first record to send updates against.
+            if self.records is not None:
+                self.save_records()
+            return
+
+        # Push files to endpoints
+        push_to_hosts(self.hosts, self.key, self.port, self.user, files, checks, self.workers)
+
+        # Only remember what made it everywhere.
+        state.update(digests)
+        save_state(self.statefile, state)
+        if self.records is not None:
+            self.save_records()
+
+
+class DhcpPublish:
+    def __init__(self, config, tmpdir, force):
+        #
+        # Get publish data from /etc/hms.ini
+        #
+        dhost = None
+        dkey = None
+        dname = None
+        duser = None
+        dport = None
+        dcheck = None
+        dworkers = WORKERS
+        dstate = STATE
+
+        # Get options from ini.
+        try:
+            dhost = config.get('DHCP', 'Host')
+            dkey = config.get('DHCP', 'Key')
+            dname = config.get('DHCP', 'DestName')
+            duser = config.get('DHCP', 'User')
+            dport = config.get('DHCP', 'Port')
+            dcheck = config.get('DHCP', 'Check', fallback=DHCPCHECK)
+            dworkers = config.getint('DHCP', 'Workers', fallback=WORKERS)
+            dstate = config.get('DHCP', 'StateFile', fallback=STATE)
+        except (configparser.NoSectionError, configparser.NoOptionError) as e:
+            raise ConfigError(str(e)) from e
+        except Exception as e:
+            raise ConfigError(f'An unexpected error occurred: {e}') from e
+
+        # No timestamp here, so unchanged data renders identically.
+        header = f"""# Generated by hms. Do not edit, changes will be overwritten.
+# Included from dhcpd.conf as {dname}
 
-def main():
-    #
-    # Get DB data from /etc/hms.ini
-    #
-    config = configparser.ConfigParser()
+"""
+        self.hosts = dhost.split(',')
+        self.key = dkey
+        self.name = dname
+        self.port = dport
+        self.user = duser
+        self.check = dcheck
+        self.workers = dworkers
+        self.statefile = dstate
+        self.force = force
+        self.out = ZoneFile(tmpdir, 'dhcptail.conf', header, self.hosts)
+
+    def cname(self, row):
+        pass
+
+    def host(self, row):
+        # Only entries marked for DHCP, and only if they have a MAC.
+        if row[3] != 'Y' or row[2] is None:
+            return
+        mac = ":".join([row[2][i:i + 2] for i in range(0, 12, 2)]).lower()
+        self.out.write(f'host {row[0]} {{ hardware ethernet {mac}; fixed-address {int2ip(row[1])}; }}\n')
+
+    def push(self):
+        state = load_state(self.statefile)
+        digest = self.out.close()
+        if not self.force and state.get(self.name) == digest:
+            print(f'DHCP {self.name} unchanged, skipping.')
+            METRICS.count('zones_skipped')
+            return
+
+        # Push to every server at once, each one checking its own config.
+        push_to_hosts(self.hosts, self.key, self.port, self.user, [(self.out.path, self.name)],
+                      [self.check] if self.check else [], self.workers)
+
+        state[self.name] = digest
+        save_state(self.statefile, state)
+
+
+def do_publish(cnx, config, dobind, dodhcp, force=False):
+    # Every output is rendered from the same snapshot into a private
+    # directory for this run.
+    import tempfile, shutil
+    tmpdir = tempfile.mkdtemp(prefix='hms-publish-')
+    try:
+        outputs = []
+        if dodhcp:
+            outputs.append(DhcpPublish(config, tmpdir, force))
+        if dobind:
+            outputs.append(BindPublish(config, tmpdir, force))
+        read_snapshot(cnx, outputs)
+        for out in outputs:
+            out.push()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def do_watch(cnx, settings, timing=False):
+    # Publish whenever the change counter moves. A burst of edits is
+    # absorbed into one publish once it has been quiet for Debounce
+    # seconds (or MaxDelay after the first edit, if it never goes quiet),
+    # and publishes are at least MinInterval apart.
+    import signal
+    if not settings.bind and not settings.dhcp:
+        print("No BIND or DHCP section found.")
+        config_bind_dhcp_usage()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    metrics = {'publishes': 0, 'failures': 0, 'changes': 0, 'last_absorbed': 0,
+               'max_absorbed': 0, 'last_publish': None, 'last_seconds': None,
+               'queued': 0, 'coalesced': 0, 'lock_wait': 0.0}
+
+    def publish(absorbed):
+        # Each publish gets its own timings and textfile.
+        global METRICS
+        METRICS = Metrics()
+        start = time.time()
+        status = 0
+        try:
+            stats = locked_publish(cnx, settings)
+        except HMSError as err:
+            metrics['failures'] += 1
+            status = 255
+            print(f'Publish failed, will try again: {err}')
+            return False
+        finally:
+            try:
+                cnx.rollback()
+            except DBError:
+                pass
+            finish_metrics(settings, 'W', timing, status)
+        metrics['lock_wait'] = round(metrics['lock_wait'] + stats['wait'], 3)
+        if stats['queued']:
+            # The holder publishes once more for these changes.
+            metrics['queued'] += 1
+            if settings.metrics:
+                save_state(settings.metrics, metrics)
+            sys.stdout.flush()
+            return True
+        metrics['publishes'] += 1
+        metrics['coalesced'] += stats['coalesced']
+        metrics['changes'] += absorbed
+        metrics['last_absorbed'] = absorbed
+        metrics['max_absorbed'] = max(metrics['max_absorbed'], absorbed)
+        metrics['last_publish'] = datetime.now().isoformat(timespec='seconds')
+        metrics['last_seconds'] = round(time.time() - start, 3)
+        print(f"{metrics['last_publish']} published {absorbed} change(s) in {metrics['last_seconds']}s, "
+              f"{metrics['publishes']} publish(es) for {metrics['changes']} change(s) so far.")
+        if settings.metrics:
+            save_state(settings.metrics, metrics)
+        sys.stdout.flush()
+        return True
+
+    # Catch up on anything made while nobody was watching; unchanged zones
+    # are skipped anyway.
+    published = get_changes(cnx)
+    print(f'hms {VERSION} watching for changes (counter at {published}).')
+    publish(0)
+    last_publish = time.monotonic()
+    seen = published
+    first = last = None
+    try:
+        while True:
+            time.sleep(settings.poll)
+            now = time.monotonic()
+            counter = get_changes(cnx)
+            if counter != seen:
+                seen = counter
+                last = now
+                if first is None:
+                    first = now
+            if first is None:
+                continue
+            if now - last < settings.debounce and now - first < settings.maxdelay:
+                continue
+            if now - last_publish < settings.mininterval:
+                continue
+            last_publish = now
+            if publish(seen - published):
+                published = seen
+                first = last = None
+    except KeyboardInterrupt:
+        pass
+
+
+def owner_alive(owner):
+    # Only a holder on this host can be looked up; one elsewhere is taken
+    # at its word until the timeout.
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def take_publish_lock(cnx, owner, timeout, force=False):
+    # Returns (None, force) when the lock is ours, or (who holds it, False)
+    # after leaving a request for them to publish once more when they are
+    # done. force is also set when requests left behind by a failed run
+    # asked for it, since this run serves them. A holder that has not
+    # finished within timeout seconds, or whose process on this host is
+    # gone, is presumed dead.
+    cnx.begin_write()
+    cur = cnx.cursor(label='lock')
+    cur.execute('SELECT owner, started, forced from hms_publish where id = 1' + cnx.row_lock)
+    row = cur.fetchone()
+    now = int(time.time())
+    if row is not None and row[0] is not None and now - row[1] < timeout and owner_alive(row[0]):
+        cur.execute('update hms_publish set pending = pending + 1, forced = forced + %s where id = 1', (int(force),))
+        cnx.commit()
+        return row, False
+    cur.execute('update hms_publish set owner = %s, started = %s, pending = 0, forced = 0 where id = 1', (owner, now))
+    cnx.commit()
+    return None, force or bool(row is not None and row[2])
+
+
+def next_publish_run(cnx, owner):
+    # Requests that came in during the last run, all served by one more
+    # run, forced if any of them asked for --force. With none, the lock is
+    # released. None if the lock was taken over meanwhile; the row is then
+    # the new holder's to manage.
+    cnx.rollback()
+    cnx.begin_write()
+    cur = cnx.cursor(label='lock')
+    cur.execute('SELECT owner, pending, forced from hms_publish where id = 1' + cnx.row_lock)
+    holder, pending, forced = cur.fetchone()
+    if holder != owner:
+        cnx.commit()
+        return None
+    if pending:
+        cur.execute('update hms_publish set pending = 0, forced = 0 where id = 1 and owner = %s', (owner,))
+    else:
+        cur.execute('update hms_publish set owner = null, started = null where id = 1 and owner = %s', (owner,))
+    cnx.commit()
+    return pending, forced > 0
 
-    # Silence warnings
-    dbhost = None
-    dbuser = None
-    dbpass = None
-    dbport = None
-    dbname = None
 
-    # Get options from ini.
+def release_publish_lock(cnx, owner):
+    # After a failed run. Requests still pending are left in the row for
+    # whoever takes the lock next; returns how many there are.
     try:
-        if not os.path.exists(CONFIG):
-            raise FileNotFoundError(f"Configuration file '{CONFIG}' not found.")
-        config.read(CONFIG)
-        # Get default settings for DB
-        dbpass = config.get('DEFAULT','Pwd')
-        dbhost = config.get('DEFAULT','Host')
-        dbuser = config.get('DEFAULT','User')
-        dbport = config.get('DEFAULT','Port')
-        dbname = config.get('DEFAULT','DB')
-    except FileNotFoundError as e:
-        print(f"Error: {e}")
-        config_default_usage()
-    except (configparser.NoSectionError, configparser.NoOptionError) as e:
-        print(f"Configuration error: {e}")
-        config_default_usage()
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        config_default_usage()
+        cnx.rollback()
+        cnx.begin_write()
+        cur = cnx.cursor(label='lock')
+        cur.execute('SELECT pending from hms_publish where id = 1' + cnx.row_lock)
+        row = cur.fetchone()
+        cur.execute('update hms_publish set owner = null, started = null where id = 1 and owner = %s', (owner,))
+        cnx.commit()
+        return row[0] if row is not None else 0
+    except DBError as err:
+        print(f'Warning: could not release the publish lock: {err}')
+        return 0
+
+
+def locked_publish(cnx, settings, force=False):
+    # Only one publish runs at a time, wherever hms runs. One that arrives
+    # meanwhile is left as a pending request, and however many pile up are
+    # folded into a single follow-up run by the holder. Failures are
+    # raised as DBError, ConfigError or PublishError, with the lock released.
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    stats = {'wait': 0.0, 'runs': 0, 'coalesced': 0, 'queued': False}
+    start = time.time()
+    with METRICS.timed('lock'):
+        holder, force = take_publish_lock(cnx, owner, settings.lock_timeout, force)
+    stats['wait'] = round(time.time() - start, 3)
+    if holder is not None:
+        since = datetime.fromtimestamp(holder[1]).strftime('%H:%M:%S')
+        print(f'Publish already running on {holder[0]} since {since}. Request queued, it will publish again when done.')
+        stats['queued'] = True
+        return stats
+    print(f'Publish lock taken in {stats["wait"]}s.')
+
+    done = False
+    try:
+        while True:
+            do_publish(cnx, settings.config, settings.bind, settings.dhcp, force)
+            stats['runs'] += 1
+            follow = next_publish_run(cnx, owner)
+            if follow is None:
+                print('The publish lock was taken over while this run was going. '
+                      'The new holder publishes anything left.')
+                break
+            pending, force = follow
+            if not pending:
+                break
+            stats['coalesced'] += pending
+            print(f'Publishing again for {pending} request(s) made meanwhile.')
+        done = True
+    finally:
+        if not done:
+            left = release_publish_lock(cnx, owner)
+            if left:
+                print(f'{left} queued request(s) not published. The next publish (-P or -W) will cover them.')
+    if stats['coalesced']:
+        print(f"{stats['coalesced']} request(s) coalesced into {stats['runs'] - 1} follow-up publish(es).")
+    return stats
+
+
+def run_command(cmd, log=None, stdin=None):
+    # With a log, output is collected there and failure is left to the caller.
+    import subprocess
+    result = subprocess.run(cmd, shell=True, capture_output=True, text=True, input=stdin)
+    if log is None:
+        print(f'Running command: {cmd}')
+        print(result.stdout, result.stderr, result.returncode)
+        if result.returncode != 0:
+            raise PublishError(f'{cmd} exited {result.returncode}.')
+    else:
+        log.append(f'Running command: {cmd}')
+        log.append(f'{result.stdout} {result.stderr} {result.returncode}')
+    return result.returncode == 0
+
+
+def push_host(h, key, port, user, ctl, files, checks):
+    # One multiplexed ssh session carries every copy and check for this host.
+    import subprocess
+    mux = f'-o ControlMaster=auto -o ControlPath={ctl}/%C -o ControlPersist=60'
+    log = []
+    ok = True
+    for local, remote in files:
+        with METRICS.timed('copy', h):
+            if not run_command(f'scp -i {key} -P {port} {mux} {local} {user}@{h}:{remote}', log):
+                ok = False
+                break
+    if ok:
+        for check in checks:
+            with METRICS.timed('check', h):
+                if not run_command(f'ssh -i {key} -p {port} {mux} {user}@{h} "{check}"', log):
+                    ok = False
+    subprocess.run(f'ssh -p {port} -o ControlPath={ctl}/%C -O exit {user}@{h}',
+                   shell=True, capture_output=True)
+    return h, ok, log
+
+
+def push_to_hosts(hosts, key, port, user, files, checks, workers):
+    import tempfile, shutil
+    from concurrent.futures import ThreadPoolExecutor
+    hosts = [h.strip() for h in hosts if h.strip()]
+    ctl = tempfile.mkdtemp(prefix='hms-ssh-')
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(hosts)))) as pool:
+            with METRICS.timed('push'):
+                results = list(pool.map(lambda h: push_host(h, key, port, user, ctl, files, checks), hosts))
+    finally:
+        shutil.rmtree(ctl, ignore_errors=True)
+
+    # Report per host, all together.
+    failed = []
+    for h, ok, log in results:
+        print(f'==== {h}: {"OK" if ok else "FAILED"}')
+        print('\n'.join(log))
+        if not ok:
+            failed.append(h)
+        else:
+            METRICS.count('files_pushed', len(files))
+    METRICS.count('hosts_pushed', len(results) - len(failed))
+    METRICS.count('hosts_failed', len(failed))
+    if failed:
+        raise PublishError('Push failed on: {}'.format(', '.join(failed)))
+
 
+def parse_args(argv):
     # try to get options
     opts=''  # remove opts not assigned warning!
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'ACMDLFPRVc:i:h:n:m:d:xX')
+        opts, args = getopt.getopt(argv, 'ABCMDLFPRVWc:i:h:n:m:d:s:xXa', ['force', 'migrate', 'serve', 'direct', 'format=',
+                                                                      'host=', 'dhcp=', 'mac=', 'desc=', 'limit=', 'after=',
+                                                                      'ranges', 'summary', 'threshold=', 'timing',
+                                                                      'no-cache', 'invalidate', 'reconcile=', 'days=',
+                                                                      'add-subnet', 'retire-subnet', 'exclude='])
     except getopt.GetoptError as err:
         # print help information and exit:
         #print(err, '\n')  # will print something like 'option -a not recognized'
         usage("{}".format(err))
 
-    ip = None
-    host = None
-    newhost = None
-    mac = None
-    desc = None
-    cname = None
-    dhcp = 'N'
-    modeset = "ACMDLFPRV"
-    mode = ""
-
-    ipregex = '^(?:(?:25[0-5]|(?:2[0-4]|1\\d|[1-9]|)\\d)\\.?\\b){4}$'
-    ipvalid = re.compile(ipregex)
-    macregex = '^(?:[0-9a-fA-F]){12}$'
-    macvalid = re.compile(macregex)
-    fqdnregex ='^[a-zA-Z][a-zA-Z0-9\\.\\-]{1,254}$'
-    fqdnvalid = re.compile(fqdnregex)
-    hostregex ='^[a-zA-Z][a-zA-Z0-9\\-]{1,31}$'
-    hostvalid = re.compile(hostregex)
-    descregex = '^[\\ a-zA-Z0-9_\\-\\.]{1,255}$'
-    descvalid = re.compile(descregex)
+    req = {
+        'ip': None,
+        'host': None,
+        'newhost': None,
+        'mac': None,
+        'desc': None,
+        'cname': None,
+        'dhcp': None,
+        'atomic': False,
+        'force': False,
+        'direct': False,
+        'subnet': None,
+        'format': 'text',
+        'filters': {},
+        'limit': None,
+        'after': None,
+        'free': None,
+        'threshold': None,
+        'timing': False,
+        'cache': True,
+        'invalidate': False,
+        'leases': None,
+        'days': STALEDAYS,
+        'exclude': None,
+        'args': args,
+    }
+    modeset = list("ABCMDLFPRVW") + ['-migrate', '-serve', '-add-subnet', '-retire-subnet']
+    modes = []
 
     for o, a in opts:
         opt = o[1:]
         #print(opt) #debug
-        if modeset.find(opt) != -1:
-            mode = mode + opt
+        if opt in modeset:
+            modes.append(opt)
         elif opt == 'i':
-            ip = a
-            if not ipvalid.match(ip):
-                usage(ip + ' is not a valid IPv4 address')
+            req['ip'] = a
+            if not IPVALID.match(a):
+                usage(a + ' is not a valid IPv4 address')
         # FIXME
         elif opt == 'c':
-            cname = a
-            if not fqdnvalid.match(cname):
-                usage(cname + ' is not a valid target FQDN')
+            req['cname'] = a
+            if not FQDNVALID.match(a):
+                usage(a + ' is not a valid target FQDN')
         elif opt == 'h':
-            host = a
-            if not hostvalid.match(host):
-                usage(host + ' is not a valid host name')
+            req['host'] = a
+            # With -C, the target may also be a name elsewhere, checked below.
+            if not HOSTVALID.match(a) and not ('.' in a and FQDNVALID.match(a)):
+                usage(a + ' is not a valid host name')
         elif opt == 'm':
-            mac = a.replace(':', '').replace('-', '').replace('.', '')
-            if not macvalid.match(mac):
+            mac = a.replace(':', '').replace('-', '').replace('.', '').lower()
+            req['mac'] = mac
+            if not MACVALID.match(mac):
                 usage(mac + ' is not a valid MAC address')
         elif opt == 'n':
-            newhost = a
-            if not hostvalid.match(newhost):
-                usage(newhost + ' is not a valid host name')
+            req['newhost'] = a
+            if not HOSTVALID.match(a):
+                usage(a + ' is not a valid host name')
         elif opt == 'd':
-            desc = a
-            if not descvalid.match(desc):
-                usage(desc + ' is not a valid description')
+            req['desc'] = a
+            if not DESCVALID.match(a):
+                usage(a + ' is not a valid description')
+        elif opt == 's':
+            try:
+                req['subnet'] = ipaddress.ip_network(a)
+            except ValueError:
+                usage(a + ' is not a valid IPv4 subnet')
+            if req['subnet'].version != 4:
+                usage(a + ' is not a valid IPv4 subnet')
         elif opt == 'x':
-            dhcp = 'Y'
+            req['dhcp'] = 'Y'
         elif opt == 'X':
-            dhcp = 'N'
+            req['dhcp'] = 'N'
+        elif opt == 'a':
+            req['atomic'] = True
+        elif opt == '-force':
+            req['force'] = True
+        elif opt == '-direct':
+            req['direct'] = True
+        elif opt == '-timing':
+            req['timing'] = True
+        elif opt == '-no-cache':
+            req['cache'] = False
+        elif opt == '-invalidate':
+            req['invalidate'] = True
+        elif opt == '-reconcile':
+            modes.append(opt)
+            req['leases'] = a
+        elif opt == '-exclude':
+            req['exclude'] = a
+        elif opt == '-days':
+            try:
+                req['days'] = float(a)
+            except ValueError:
+                usage(a + ' is not a valid number of days')
+        elif opt == '-format':
+            req['format'] = a.lower()
+            if req['format'] not in FORMATS:
+                usage(a + ' is not one of ' + ', '.join(FORMATS))
+        elif opt == '-host':
+            req['filters']['host'] = a
+            if not HOSTGLOB.match(a):
+                usage(a + ' is not a valid host name pattern')
+        elif opt in ('-dhcp', '-mac'):
+            flag = a.upper()[:1]
+            if flag not in ('Y', 'N'):
+                usage(f'--{opt[1:]} takes y or n')
+            req['filters'][opt[1:]] = flag
+        elif opt == '-desc':
+            req['filters']['desc'] = a
+            if not DESCVALID.match(a):
+                usage(a + ' is not a valid description')
+        elif opt == '-limit':
+            if not a.isdigit() or int(a) < 1:
+                usage(a + ' is not a valid limit')
+            req['limit'] = int(a)
+        elif opt in ('-ranges', '-summary'):
+            req['free'] = opt[1:]
+        elif opt == '-threshold':
+            try:
+                req['threshold'] = float(a)
+            except ValueError:
+                usage(a + ' is not a valid percentage')
+        elif opt == '-after':
+            req['after'] = a
+            if not IPVALID.match(a):
+                usage(a + ' is not a valid IPv4 address')
         else:
             assert False, 'unhandled option'
 
     # process options
     #print('Mode is', mode) #debug
-    if len(mode) > 1:
-        usage('Choose one of add, modify, delete, list, free, or version.')
+    if len(modes) > 1:
+        usage('Choose one of add, bulk, modify, delete, list, free, or version.')
+    req['mode'] = modes[0] if modes else ''
+    if req['host'] is not None and '.' in req['host'] and req['mode'] != 'C':
+        usage(req['host'] + ' is not a valid host name')
+    return req
+
+
+def run_read(cnx, req):
+    subnet = req['subnet']
+    if req['mode'] == 'L':
+        do_list(cnx, req['ip'], req['host'], subnet, req['format'], req['filters'], req['limit'], req['after'])
+    elif req['free'] == 'summary':
+        do_free_summary(cnx, subnet, req['format'], req['threshold'])
+    elif req['free'] == 'ranges':
+        do_free_ranges(cnx, subnet, req['format'])
+    else:
+        do_freelist(cnx, subnet, req['format'], req['limit'], req['after'])
 
-    if mode == 'V':
-        do_version()
 
-    # Connect to server
-    try:
-        cnx = mysql.connector.connect(
-        host=dbhost,
-        port=dbport,
-        user=dbuser,
-        database=dbname,
-        password=dbpass)
-    except mysql.connector.Error as err:
-        print(f'Error connecting to MySQL: {err}')
-        sys.exit(2)
+def run_mode(cnx, settings, req):
+    mode = req['mode']
+    ip = req['ip']
+    host = req['host']
+    mac = req['mac']
+    desc = req['desc']
+    dhcp = req['dhcp']
+    subnet = req['subnet']
 
     if mode == 'A':
-        do_add(cnx, ip, host, desc, mac, dhcp)
+        do_add(cnx, ip, host, desc, mac, dhcp, subnet)
+    elif mode == 'B':
+        args = req['args']
+        do_bulk(cnx, args[0] if args else None, req['atomic'])
     elif mode == 'M':
         do_modify(cnx, host, desc, mac, dhcp)
     elif mode == 'D':
         do_delete(cnx, ip, host)
-    elif mode == 'L':
-        do_list(cnx, ip, host)
-    elif mode == 'F':
-        do_freelist(cnx)
+    elif mode in ('L', 'F'):
+        cache = None
+        if settings.cache_path and req['cache']:
+            cache = open_cache(cnx, settings, req['invalidate'])
+        try:
+            run_read(cache or cnx, req)
+        finally:
+            if cache is not None:
+                cache.close()
     # FIXME
     elif mode == 'C':
-        do_cname(cnx, cname, host)
+        do_cname(cnx, req['cname'], host)
     # FIXME
     elif mode == 'R':
-        do_rename_host(cnx, host, newhost)
+        do_rename_host(cnx, host, req['newhost'])
     elif mode == 'P':
-        config = configparser.ConfigParser()
-        config.read(CONFIG)
-        dobind = config.has_section('BIND')
-        dodhcp = config.has_section('DHCP')
-
-        if not dobind and not dodhcp:
+        if not settings.bind and not settings.dhcp:
             print("No BIND or DHCP section found.")
             config_bind_dhcp_usage()
 
-        if dodhcp:
-            print("DHCP is not yet implemented.")  # do dhcp push
-            # do_dhcp_publish(cnx, config)
-
-        if dobind:
-            do_bind_publish(cnx, config)
+        if cli_call(255, locked_publish, cnx, settings, req['force'])['queued']:
+            sys.exit(9)
+    elif mode == 'W':
+        do_watch(cnx, settings, req['timing'])
+    elif mode == '-migrate':
+        do_migrate(cnx)
+    elif mode == '-add-subnet':
+        do_add_subnet(cnx, subnet, desc, req['exclude'], req['force'])
+    elif mode == '-retire-subnet':
+        do_retire_subnet(cnx, subnet)
+    elif mode == '-reconcile':
+        do_reconcile(cnx, req['leases'], subnet, req['format'], req['filters'], req['days'])
     else:
         usage('FATAL: Unknown mode')
 
+
+class ThreadStdout:
+    # print() from a daemon thread goes to that thread's client.
+    def __init__(self, default):
+        import threading
+        self.default = default
+        self.local = threading.local()
+
+    def write(self, text):
+        return getattr(self.local, 'buf', self.default).write(text)
+
+    def flush(self):
+        getattr(self.local, 'buf', self.default).flush()
+
+
+class ReplyStream:
+    # A daemon client's output, passed on while the mode runs as JSON
+    # lines of {"out": text}, so a long listing is never held whole. The
+    # last line is {"status": n}. A client that went away gets nothing
+    # more, but the mode still runs to the end.
+    CHUNK = 65536
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.parts = []
+        self.size = 0
+        self.gone = False
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.CHUNK:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.parts:
+            text = ''.join(self.parts)
+            self.parts = []
+            self.size = 0
+            self.send({'out': text})
+
+    def send(self, reply):
+        if self.gone:
+            return
+        try:
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+        except OSError:
+            self.gone = True
+
+    def finish(self, status):
+        self.flush()
+        self.send({'status': status})
+
+
+def daemon_request(settings, argv):
+    # Returns the exit status from the daemon, or None to run directly.
+    # Only a daemon that cannot be reached is run around: once the request
+    # is sent it may already have been carried out, so a lost or garbled
+    # reply is an error rather than a reason to run it a second time.
+    path = settings.socket
+    if not os.path.exists(path):
+        return None
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    except OSError:
+        return None
+    try:
+        with sock, sock.makefile('rwb') as stream:
+            stream.write(json.dumps({'argv': argv}).encode() + b'\n')
+            stream.flush()
+            # Output as it comes, then the exit status.
+            for line in stream:
+                reply = json.loads(line)
+                if 'status' in reply:
+                    return int(reply['status'])
+                text = reply['out']
+                try:
+                    sys.stdout.write(text)
+                except BrokenPipeError:
+                    # output piped into head and the like.
+                    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                    return 1
+        raise ValueError('connection closed before the end of the reply')
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        sys.stdout.flush()
+        print(f'No usable reply from the hms daemon on {path}: {err}')
+        print('The request may or may not have been carried out; check before running it again.')
+        return 255
+
+
+def do_serve(settings):
+    # Keep the parsed config and a pool of connections, and run the
+    # -A/-C/-D/-F/-L/-M/-P/-R modes for clients on a unix socket.
+    import queue, signal, socketserver
+    path = settings.socket
+    size = settings.pool
+
+    pool = queue.Queue()
+    try:
+        for i in range(size):
+            pool.put(connect_db(settings))
+    except DBError as err:
+        print(f'Error connecting to database: {err}')
+        sys.exit(2)
+
+    out = ThreadStdout(sys.stdout)
+    sys.stdout = out
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                argv = json.loads(self.rfile.readline())['argv']
+            except (ValueError, KeyError, TypeError):
+                return
+            out.local.buf = ReplyStream(self.wfile)
+            status = 0
+            cnx = None
+            try:
+                req = parse_args(argv)
+                if req['mode'] not in DAEMON_MODES:
+                    usage('Mode not handled by the daemon.')
+                cnx = pool.get()
+                try:
+                    cnx.ping()
+                except DBError:
+                    # Gone and not coming back by itself; a fresh one takes
+                    # its place in the pool, or it is tried again next time.
+                    try:
+                        cnx = connect_db(settings)
+                    except DBError as err:
+                        print(f'Error connecting to database: {err}')
+                        sys.exit(2)
+                run_mode(cnx, settings, req)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception as e:
+                print(f'An unexpected error occurred: {e}')
+                status = 255
+            finally:
+                if cnx is not None:
+                    # Anything left open by a failed request goes away.
+                    try:
+                        cnx.rollback()
+                    except DBError:
+                        try:
+                            cnx = connect_db(settings)
+                        except DBError as err:
+                            print(f'Error reconnecting to database: {err}')
+                    pool.put(cnx)
+            out.local.buf.finish(status)
+            del out.local.buf
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    os.chmod(path, settings.socket_mode)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f'hms {VERSION} serving on {path} with {size} connection(s).')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def finish_metrics(settings, mode, timing, status):
+    if timing:
+        METRICS.report()
+    if settings.textfile_dir:
+        METRICS.write_textfile(settings.textfile_dir, mode.lstrip('-'), status)
+
+
+def main():
+    # Options first, so bad input fails before any config, driver or connection.
+    req = parse_args(sys.argv[1:])
+    mode = req['mode']
+
+    if mode == 'V':
+        do_version()
+
+    #
+    # Get DB data from /etc/hms.ini
+    #
+    try:
+        with METRICS.timed('config'):
+            settings = Settings(CONFIG)
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        config_default_usage()
+    except (configparser.Error, ValueError) as e:
+        print(f"Configuration error: {e}")
+        config_default_usage()
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        config_default_usage()
+
+    if mode == '-serve':
+        do_serve(settings)
+        sys.exit(0)
+
+    # Hand off to the daemon if one is running. Timing is about this
+    # process, so --timing always runs directly.
+    if mode in DAEMON_MODES and not req['direct'] and not req['timing']:
+        status = daemon_request(settings, sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+    status = 0
+    try:
+        # Connect to server
+        try:
+            with METRICS.timed('connect'):
+                cnx = connect_db(settings)
+        except DBError as err:
+            print(f'Error connecting to database: {err}')
+            sys.exit(2)
+
+        run_mode(cnx, settings, req)
+    except BrokenPipeError:
+        # output piped into head and the like.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        status = 1
+        sys.exit(1)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        raise
+    finally:
+        if mode != 'W':
+            finish_metrics(settings, mode, req['timing'], status)
+
     # Close connection
     cnx.close()
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+#
+# Check the dhcpd lease parser and --reconcile against samples/dhcpd.leases,
+# whose blocks are commented with what each one is there to catch.
+#
+
+import getopt, sys, configparser, os, subprocess
+import calendar, json, tempfile, shutil, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import hms
+
+HMS = os.path.join(HERE, 'hms.py')
+LEASES = os.path.join(HERE, 'samples', 'dhcpd.leases')
+
+
+def utc(*stamp):
+    return calendar.timegm(stamp + (0, 0, 0))
+
+
+# What iter_leases must yield, in file order.
+PARSED = [
+    ('10.1.0.10', '00112233440a', utc(2026, 10, 1, 8, 0, 0), 'active', 'alpha'),
+    ('10.1.0.11', '00112233440b', utc(2025, 1, 1, 8, 0, 0), 'free', None),
+    ('10.1.0.12', '00112233440c', utc(2026, 10, 1, 9, 0, 0), 'active', 'gamma'),
+    ('10.1.0.50', '00112233440d', utc(2026, 10, 1, 8, 0, 0), 'active', 'delta'),
+    ('10.1.0.14', '00112233440e', utc(2026, 9, 1, 8, 0, 0), 'active', 'epsilon'),
+    ('10.1.0.15', '00112233440f', utc(2026, 10, 1, 7, 0, 0), 'active', None),
+    ('10.1.0.16', '001122334410', utc(2026, 10, 1, 6, 0, 0), 'active', 'eta'),
+    ('10.1.0.14', '001122334499', utc(2026, 10, 1, 11, 0, 0), 'active', 'stranger'),
+]
+
+# host, ip, mac, dhcp
+ENTRIES = [
+    ('alpha', '10.1.0.10', '00112233440a', 'Y'),
+    ('beta', '10.1.0.11', '00112233440b', 'Y'),
+    ('gamma', '10.1.0.12', '00112233440c', 'Y'),
+    ('delta', '10.1.0.13', '00112233440d', 'Y'),
+    ('epsilon', '10.1.0.14', '00112233440e', 'Y'),
+    ('zeta', '10.1.0.15', '00112233440f', 'N'),
+    ('eta', '10.1.0.16', '001122334410', 'Y'),
+    ('theta', '10.1.0.17', None, 'N'),
+    ('iota', '10.1.0.18', '001122334412', 'Y'),
+]
+
+# Anything not seen since this is stale.
+CUTOFF = utc(2026, 6, 1, 0, 0, 0)
+
+# status, host, ip, mac, lease_ip, lease_mac, seen, client
+REPORT = [
+    ('mismatch', 'delta', '10.1.0.13', '00:11:22:33:44:0d', '10.1.0.50', '00:11:22:33:44:0d', '2026-10-01 08:00', 'delta'),
+    ('mismatch', 'epsilon', '10.1.0.14', '00:11:22:33:44:0e', '10.1.0.14', '00:11:22:33:44:99', '2026-10-01 11:00', 'stranger'),
+    ('stale', 'beta', '10.1.0.11', '00:11:22:33:44:0b', None, None, '2025-01-01 08:00', None),
+    ('stale', 'iota', '10.1.0.18', '00:11:22:33:44:12', None, None, None, None),
+    ('unknown', None, None, None, '10.1.0.14', '00:11:22:33:44:99', '2026-10-01 11:00', 'stranger'),
+]
+
+
+def usage(msg=None):
+    if msg is not None:
+        print('\nERROR: ' + msg + '\n')
+    print('''
+Usage:  leasecheck.py [ -v ]
+
+ -v => Show the output of each hms run.
+
+Uses a throwaway SQLite database in a temporary directory.
+''')
+    sys.exit(1)
+
+
+def seed(cnx):
+    cur = cnx.cursor()
+    for stmt in cnx.SCHEMA:
+        cur.execute(stmt)
+    cur.executemany('insert into hms_ip (ip, host, mac, dhcp) values (%s, %s, %s, %s)',
+                    [(hms.ip2int(ip), host, mac, dhcp) for host, ip, mac, dhcp in ENTRIES])
+    cnx.commit()
+
+
+def run_hms(env, verbose, *args):
+    proc = subprocess.run([sys.executable, HMS, '--direct'] + list(args), env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if verbose:
+        print(proc.stdout)
+    return proc.returncode, proc.stdout
+
+
+def check_parse(fails):
+    with open(LEASES) as file:
+        got = list(hms.iter_leases(file))
+    for n, (want, have) in enumerate(zip(PARSED, got)):
+        if want != have:
+            fails.append(f'lease {n}: expected {want}, parsed {have}')
+    if len(got) != len(PARSED):
+        fails.append(f'{len(got)} leases parsed, expected {len(PARSED)}')
+    for stmt, want in (('cltt 4 2026/10/01 08:00:00;', utc(2026, 10, 1, 8, 0, 0)),
+                       ('cltt epoch 1790845200; # Thu Oct 01 09:00:00 2026', 1790845200),
+                       ('ends never;', None)):
+        if hms.lease_time(stmt) != want:
+            fails.append(f'lease_time({stmt!r}) = {hms.lease_time(stmt)}, expected {want}')
+
+
+def check_report(env, verbose, fails):
+    days = f'{(time.time() - CUTOFF) / 86400:.4f}'
+    rc, out = run_hms(env, verbose, '--reconcile=' + LEASES, '--days=' + days, '--format=json')
+    if rc != 7:
+        fails.append(f'--reconcile exited {rc} with differences, expected 7')
+    fields = ('status', 'host', 'ip', 'mac', 'lease_ip', 'lease_mac', 'seen', 'client')
+    try:
+        got = [tuple(json.loads(line)[f] for f in fields) for line in out.splitlines()]
+    except (ValueError, KeyError):
+        fails.append(f'--reconcile --format=json printed something else:\n{out}')
+        return
+    if got != REPORT:
+        fails.append('--reconcile rows differ:\n  expected ' + '\n           '.join(map(str, REPORT))
+                     + '\n  got      ' + '\n           '.join(map(str, got)))
+
+    rc, out = run_hms(env, verbose, '--reconcile=' + LEASES, '--days=' + days, '-s', '10.1.0.12/32')
+    if rc != 0:
+        fails.append(f'--reconcile exited {rc} for a subnet that agrees, expected 0\n{out}')
+    rc, out = run_hms(env, verbose, '--reconcile=' + os.path.join(HERE, 'samples', 'missing.leases'))
+    if rc != 8 or 'Traceback' in out:
+        fails.append(f'--reconcile exited {rc} for a missing file, expected 8\n{out}')
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'v')
+    except getopt.GetoptError as err:
+        usage("{}".format(err))
+    verbose = ('-v', '') in opts
+
+    fails = []
+    check_parse(fails)
+    tmpdir = tempfile.mkdtemp(prefix='hms-leasecheck-')
+    try:
+        config = configparser.ConfigParser()
+        config.read_dict({'DEFAULT': {'Backend': 'sqlite', 'Path': os.path.join(tmpdir, 'hms.db')},
+                          'DAEMON': {'Socket': os.path.join(tmpdir, 'none.sock')}})
+        cfgpath = os.path.join(tmpdir, 'hms.ini')
+        with open(cfgpath, 'w') as file:
+            config.write(file)
+        cnx = hms.connect_db(hms.Settings(cfgpath))
+        seed(cnx)
+        cnx.close()
+        # Report times are local, the expected ones UTC.
+        check_report(dict(os.environ, HMS_CONFIG=cfgpath, TZ='UTC'), verbose, fails)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    for fail in fails:
+        print('FAIL ' + fail)
+    if fails:
+        sys.exit(1)
+    print(f'OK: {len(PARSED)} leases parsed, {len(REPORT)} differences reported as expected.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+#
+# Hammer the free IP allocator from many processes and threads at once
+# and check that no address is ever handed out twice.
+#
+
+import getopt, sys, configparser, os, subprocess
+import re, tempfile, shutil, threading, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import hms
+
+HMS = os.path.join(HERE, 'hms.py')
+SUBNET = '10.99.0.0/16'
+FIRST = (10 << 24) + (99 << 16)
+USED = re.compile(r'^Using free IP: (\S+)$', re.M)
+
+
+def usage(msg=None):
+    if msg is not None:
+        print('\nERROR: ' + msg + '\n')
+    print('''
+Usage:  stress.py -c stress.ini [ -n processes ] [ -t threads ] [ -x extra ]
+
+ -c => hms.ini style file whose DEFAULT section points at a scratch database,
+       MySQL or SQLite. Its name (DB or Path) must contain "bench" or "stress";
+       the hms tables there are recreated.
+ -n => hms -A processes started at once. (default 32)
+ -t => Threads calling HMS.add at the same time. (default 16)
+ -x => Extra adds once the pool is empty, which must all fail. (default 8)
+''')
+    sys.exit(1)
+
+
+def seed(cnx, size):
+    # A pool of exactly size free addresses in SUBNET.
+    cur = cnx.cursor()
+    for table in ('hms_ip', 'hms_cname', 'hms_subnet', 'hms_change', 'hms_publish'):
+        cur.execute(f'drop table if exists {table}')
+    for stmt in cnx.SCHEMA:
+        cur.execute(stmt)
+    cur.execute('insert into hms_subnet (first, last, bits) values (%s, %s, 16)', (FIRST, FIRST + 65535))
+    cur.executemany('insert into hms_ip (ip, dhcp) values (%s, %s)', [(FIRST + 1 + i, 'N') for i in range(size)])
+    cnx.commit()
+
+
+def start_adds(env, names):
+    # Every other one asks for the subnet, the rest for any free address.
+    procs = []
+    for n, name in enumerate(names):
+        args = [sys.executable, HMS, '-A', '-h', name, '-d', 'stress', '--direct']
+        if n % 2:
+            args += ['-s', SUBNET]
+        procs.append((name, subprocess.Popen(args, env=env, stdout=subprocess.PIPE,
+                                             stderr=subprocess.STDOUT, text=True)))
+    return procs
+
+
+def api_adds(cfgpath, names, results):
+    # One HMS object, so one connection, per thread, all released together.
+    gate = threading.Barrier(len(names))
+
+    def run(name):
+        api = hms.HMS(cfgpath)
+        try:
+            gate.wait()
+            results[name] = api.add(name, desc='stress').ip
+        except hms.NoFreeIPError:
+            results[name] = None
+        except Exception as err:
+            results[name] = err
+        finally:
+            api.close()
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in names]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def collect(procs, threads, results, fails):
+    # name -> address for every add that worked; failures go in fails.
+    got = {}
+    for name, proc in procs:
+        out = proc.communicate()[0]
+        if 'Traceback' in out:
+            fails.append(f'{name}: traceback\n{out}')
+        m = USED.search(out)
+        if proc.returncode == 0 and m:
+            got[name] = m.group(1)
+        elif proc.returncode == 3 and 'No free IPs available' in out:
+            got[name] = None
+        else:
+            fails.append(f'{name}: exit {proc.returncode}\n{out}')
+    for t in threads:
+        t.join()
+    for name, ip in results.items():
+        if isinstance(ip, Exception):
+            fails.append(f'{name}: {type(ip).__name__}: {ip}')
+        else:
+            got[name] = ip
+    return got
+
+
+def run_round(env, cfgpath, label, nprocs, nthreads):
+    print(f'{label}: {nprocs} processes and {nthreads} threads...')
+    results = {}
+    fails = []
+    start = time.perf_counter()
+    procs = start_adds(env, [f'{label}p{i}' for i in range(nprocs)])
+    threads = api_adds(cfgpath, [f'{label}t{i}' for i in range(nthreads)], results) if nthreads else []
+    got = collect(procs, threads, results, fails)
+    print(f'{label}: done in {time.perf_counter() - start:.2f}s')
+    return got, fails
+
+
+def check_db(settings, expect):
+    # What the table says must agree with what every caller was told.
+    fails = []
+    cnx = hms.connect_db(settings)
+    cur = cnx.cursor()
+    cur.execute('SELECT host, ip from hms_ip where host is not null')
+    rows = {host: hms.int2ip(ip) for host, ip in cur.fetchall()}
+    cnx.close()
+    for name, ip in expect.items():
+        if rows.get(name) != ip:
+            fails.append(f'{name}: told {ip}, table has {rows.get(name)}')
+    if len(set(rows.values())) != len(rows):
+        fails.append('an address is assigned to more than one host')
+    return fails
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'c:n:t:x:')
+    except getopt.GetoptError as err:
+        usage("{}".format(err))
+
+    cfgfile = None
+    nprocs = 32
+    nthreads = 16
+    extra = 8
+    try:
+        for o, a in opts:
+            if o == '-c':
+                cfgfile = a
+            elif o == '-n':
+                nprocs = max(1, int(a))
+            elif o == '-t':
+                nthreads = max(0, int(a))
+            elif o == '-x':
+                extra = max(1, int(a))
+    except ValueError as err:
+        usage("{}".format(err))
+
+    if cfgfile is None or not os.path.exists(cfgfile):
+        usage('A config file for the scratch database is required.')
+    config = configparser.ConfigParser()
+    config.read(cfgfile)
+    if config.get('DEFAULT', 'Backend', fallback='mysql').lower() == 'sqlite':
+        dbname = config.get('DEFAULT', 'Path', fallback='')
+    else:
+        dbname = config.get('DEFAULT', 'DB', fallback='')
+    if 'bench' not in os.path.basename(dbname) and 'stress' not in os.path.basename(dbname):
+        usage('Refusing to use a database whose name does not contain "bench" or "stress".')
+
+    # Only the scratch database: no daemon, cache or metrics from elsewhere.
+    tmpdir = tempfile.mkdtemp(prefix='hms-stress-')
+    try:
+        out = configparser.ConfigParser()
+        out.read_dict({'DEFAULT': dict(config.defaults()),
+                       'DAEMON': {'Socket': os.path.join(tmpdir, 'none.sock')}})
+        cfgpath = os.path.join(tmpdir, 'hms.ini')
+        with open(cfgpath, 'w') as file:
+            out.write(file)
+        settings = hms.Settings(cfgpath)
+        env = dict(os.environ, HMS_CONFIG=cfgpath)
+
+        # A few addresses more than the first round takes, then more
+        # callers than are left.
+        spare = max(1, extra // 2)
+        size = nprocs + nthreads + spare
+        cnx = hms.connect_db(settings)
+        seed(cnx, size)
+        cnx.close()
+        print(f'Pool of {size} addresses on {settings.backend}.')
+
+        got, fails = run_round(env, cfgpath, 'fill', nprocs, nthreads)
+        if any(ip is None for ip in got.values()):
+            fails.append('an add was refused while the pool still had room')
+        more, late = run_round(env, cfgpath, 'drain', spare + extra, 0)
+        fails += late
+        won = [name for name, ip in more.items() if ip is not None]
+        if len(won) != spare:
+            fails.append(f'{len(won)} adds succeeded for the last {spare} addresses')
+        if len(more) - len(won) != extra:
+            fails.append(f'{len(more) - len(won)} adds exited 3 on an empty pool, expected {extra}')
+        got.update(more)
+
+        assigned = {name: ip for name, ip in got.items() if ip is not None}
+        if len(set(assigned.values())) != len(assigned):
+            fails.append('the same address was handed out twice')
+        fails += check_db(settings, assigned)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    for fail in fails:
+        print('FAIL ' + fail)
+    if fails:
+        sys.exit(1)
+    print(f'OK: {len(assigned)} addresses handed out once each, {extra} adds refused with exit 3.')
+
+
+if __name__ == '__main__':
+    main()